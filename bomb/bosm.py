@@ -23,28 +23,41 @@ from bomb.log import Blog
 def bosm(args):
 
     args.target = _fuzzy_target(args.target)
-
-    ## cleanup all existing logs
-    if 'clean' in args.target:
-        try: shutil.rmtree(Bos.logdir)
-        except: pass
-
+    if args.owner and args.target == ['all']: args.target = []
 
     ## BOS internal environments required by logging system.
     os.environ['_BOS_DEBUG_'] = 'yes' if args.debug == True else 'no'
     os.environ['_BOS_TRACE_'] = 'yes' if args.trace == True else 'no'
     os.environ['_BOS_VERBOSE_'] = 'yes' if args.verbose == True else 'no'
+    os.environ['_BOS_LOGZ_'] = 'yes' if args.compress_logs == True else 'no'
+    os.environ['_BOS_MEMBUDGET_'] = str(_mem_budget(args.mem_budget))
+    os.environ['_BOS_INCREMENTAL_'] = args.incremental or ''
+    os.environ['_BOS_KEEP_STAGING_'] = 'yes' if args.keep_staging == True else 'no'
+    os.environ['_BOS_PKGCACHE_'] = (
+        os.path.abspath(args.pkgcache_dir or Bos.pkgcachedir)
+        if args.pkgcache or args.pkgcache_dir else '')
+
+    ## queries are answered from package index, nothing is set up
+    if args.owner or (args.target and not
+                      [t for t in args.target if not _is_query(t)]):
+        _query(args)
+
+    ## cleanup all existing logs
+    if 'clean' in args.target:
+        try: shutil.rmtree(Bos.logdir)
+        except: pass
 
 
     ### bootstrap build system
     Bos.setup()
     Blog.debug("entering to build system, topdir: %s" % Bos.topdir)
 
+    if 'stats' in args.target: _print_stats()
+
 
     if _bootstrapcheck():
         Blog.debug("bootstrap required.")
         Bos.touch(os.path.join(Bos.cachedir, '.rebootstrap'))
-        Bos.touch(os.path.join(Bos.cachedir, '.rebuild'))
 
     ret = 0
     if not 'bootstrap' in args.target:
@@ -56,22 +69,48 @@ def bosm(args):
 
     ## from this point on, build system is bootstraped and ready:
     ## - all envorinments are in place and ready to consume build target
-    if 'info' in args.target: _print_info()
 
-    if 'all' in args.target: _check_package_version()
+    ## package inputs are checked for any build, queries change nothing
+    builds = [t for t in args.target
+              if t not in ['bootstrap', 'clean'] and not _is_query(t)]
+    queries = [t for t in args.target if _is_query(t)]
+    if builds: _check_package_version()
+
+    from bomb.stats import BosStats
+    BosStats.prune()
+
+    ## one job budget for all packages and their makes
+    from bomb.jobserver import BosJobServer
+    if not BosJobServer.get():
+        BosJobServer.create(args.jobs or BosJobServer.default_jobs()).export()
+
+    scheduler = None
+    if not builds: pass
+    elif 'native' == args.scheduler:
+        from bomb.scheduler import BosScheduler
+        scheduler = BosScheduler(args.jobs, args.order)
+    elif 0 == ret: _write_build_order(args.order)
 
     if 0 == ret:
         for target in args.target:
-            if target[-5:] == '-info': _print_pkg_info(target[:-5])
+            if _is_query(target): continue
+
+            if scheduler and scheduler.can_build(target):
+                Blog.debug("package %s native build" % target)
+                scheduler.build([target])
+                continue
 
             Blog.debug("package %s top-level make" % target)
             call(['make', '-C', Bos.cachedir,
                   '-f', Bos.topdir + 'bos/mk/main.mk',
-                  '-j' + str(args.jobs) if args.jobs else '-j',
                   '--no-print-directory', target])
 
-    print ''
-    print 'build summary at: {0}'.format(Blog.name())
+    if builds or not (args.owner or queries):
+        print ''
+        print 'build summary at: {0}'.format(Blog.name())
+
+    ## queries are answered all together, once builds are done
+    if args.owner or queries: _answer(args, queries)
 
 
 def _ambiguous_target(target, match):
@@ -89,15 +128,16 @@ def _fuzzy_target(target):
 
     pkgs_all = []
     builtins = ['prepare', 'config', 'compile', 'install',
-                'clean', 'purge', 'info']
+                'clean', 'purge', 'info', 'verify', 'rdeps', 'files']
 
     pkgs = _all_pkgs()
 
     pkgs_all.extend(pkgs)
-    pkgs_all.extend(['all', 'bootstrap', 'clean', 'info'])
+    pkgs_all.extend(['all', 'bootstrap', 'clean', 'info', 'stats'])
 
-    match = []
     for t in target:
+        match = []
+
         ## look for exact match first
         if t in pkgs_all:
             target_real.append(t)
@@ -182,16 +222,42 @@ def _fuzzy_target(target):
 def _check_package_version():
 
     from bomb.package import BosPackage
+    from bomb.metadb import BosMetaDB
+    from bomb.gitrepo import bos_git_version
+
+    ## all packages with their versions in one go, open a package only when
+    ## its .mk changed or it is not yet known
+    meta = BosMetaDB.packages()
 
     names = _all_pkgs()
     for name in names:
-        pkg = BosPackage.open(name)
+        m = meta.get(name)
+        if (not m or m[5] is None or
+            os.path.getmtime(os.path.join(Bos.topdir, m[0])) != m[1]):
+            pkg = BosPackage.open(name)
+
+            ## version of older releases names the checked out ref, package
+            ## is taken as built of its current inputs if that still matches
+            if (m and m[5] is None and
+                pkg._version == bos_git_version(pkg._gitdir)):
+                pkg._version = pkg._get_version()
+                pkg._flush()
+
+            meta[name] = (pkg.mk, pkg._mtime, pkg._version, pkg._gitdir,
+                          pkg._src, pkg._patch)
+
+    ## current versions of all packages, fingerprinted in parallel
+    versions = BosPackage.versions(dict((name, (meta[name][0], meta[name][5],
+                                                meta[name][3], meta[name][4]))
+                                        for name in names))
 
+    for name in names:
+        m = meta[name]
         dot_v = os.path.join(Bos.statesdir, name + '.v')
         dot_d = os.path.join(Bos.statesdir, name + '.d')
         if not os.path.exists(dot_v): Bos.touch(dot_v)
 
-        if True == pkg.is_version_diff():
+        if versions[name] != m[2]:
             if os.path.exists(dot_d):
                 Blog.info("%s: rebuild required" % name)
                 Bos.touch(dot_v)
@@ -201,6 +267,7 @@ def _check_package_version():
                Bos.touch(os.path.join(Bos.statesdir, name + '.f'))
                Bos.touch(os.path.join(Bos.statesdir, name + '.b'))
                Bos.touch(dot_d)
+               Bos.touch(os.path.join(Bos.statesdir, name + '.c'))
 
 
 def _all_pkgs():
@@ -216,41 +283,299 @@ def _all_pkgs():
     return pkgs
 
 
+def _mem_budget(size):
+    """return memory budget in KB, from size given as bytes or K/M/G."""
+
+    from bomb.util import bos_mem_available
+
+    if size is None: return bos_mem_available() or 0
+    units = {'K': 1, 'M': 1 << 10, 'G': 1 << 20}
+    try:
+        if size[-1:].upper() in units:
+            return int(float(size[:-1]) * units[size[-1:].upper()])
+        return int(size) / 1024
+    except ValueError:
+        print ('\ninvalid memory budget: %s\n' % size)
+        sys.exit(-1)
+
+
+def _write_build_order(order):
+    """
+    write packages in order of their critical path for main.mk, so that
+    make starts long build chains first. configured order if not critical,
+    or there is no dependency graph.
+    """
+
+    from bomb.depgraph import BosDepGraph
+    from bomb.stats import BosStats
+
+    fn = os.path.join(Bos.cachedir, 'order')
+    graph = BosDepGraph.load(fatal = False) if order == 'critical' else None
+    if not graph:
+        if os.path.exists(fn): os.unlink(fn)
+        return
+
+    prio = graph.critical_path(BosStats.durations())
+    names = graph.names()
+    names.sort(key = lambda pn: -prio[pn])
+
+    with open(fn + '.tmp', 'w') as f: f.write(''.join([pn + '\n' for pn in names]))
+    os.rename(fn + '.tmp', fn)
+
+
+def _is_query(target):
+    """return True if target only queries packages, building nothing."""
+
+    return target.split('-')[-1] in ['info', 'verify', 'rdeps', 'files']
+
+
 def _bootstrapcheck():
 
         if not os.path.exists(os.path.join(Bos.cachedir, '.bootstrap')):
             return True
         if open(os.path.join(Bos.cachedir, '.bootstrap'),'r').read() != Bos.topdir:
             return True
+        ## bootstrapped by a release not saving dependency graph
+        if not os.path.exists(os.path.join(Bos.cachedir, 'depgraph')):
+            return True
         return False
 
 
-def _print_info():
+def _query(args):
+    """
+    answer queries from package index as of last bootstrap and builds, no
+    setup, bootstrap or make at all, and exit.
 
-    print '\nall buidable packages:\n%s' % ('-' * 80)
+    return if there is no index yet, or distro config changed since last
+    bootstrap, to answer queries once bootstrapped.
+    """
 
-    pkgs = _all_pkgs()
+    try:
+        mtime = os.path.getmtime(os.path.join(Bos.cachedir, '.bootstrap'))
+        if not os.path.exists(Bos.metadb): return
+        for fn in ['packages', 'buildenv']:
+            if os.path.getmtime(os.path.join(Bos.distrodir, 'config', fn)) > mtime:
+                return
+    except OSError: return
 
-    pkgs.sort()
-    if len(pkgs) % 2 != 0: pkgs.append(' ')
-    split = len(pkgs) / 2
-    l1 = pkgs[0:split]
-    l2 = pkgs[split:]
-    for key, value in zip(l1, l2): print '%-40s %s' % (key, value)
+    from sqlite3 import DatabaseError
+    from bomb.metadb import BosMetaDB
 
-    print
-    sys.exit(0)
+    ## unreadable or outdated database is left to setup and bootstrap
+    try:
+        with BosMetaDB.reading(): _answer(args, args.target)
+    except DatabaseError: pass
 
 
-def _print_pkg_info(name):
+def _answer(args, targets):
+    """print answers of query targets and owner queries, and exit."""
 
-    from bomb.package import BosPackage
+    import json
+    from bomb.depgraph import BosDepGraph
+    from bomb.metadb import BosMetaDB
 
-    Blog.debug('print package info: %s' % name)
-    try:
-        pkg = BosPackage.open(name)
-        pkg.dump()
-    except:
-        Blog.fatal('invalid package name: %s' % name)
+    graph = BosDepGraph.load(fatal = False)
+    if not graph:
+        sys.stderr.write('no package index, bootstrap required.\n')
+        sys.exit(1)
+
+    answers = []
+    for t in targets:
+        if t == 'info': answers.append((t, _info(graph)))
+        elif t[-5:] == '-info': answers.append((t, _pkg_info(t[:-5])))
+        elif t[-6:] == '-files': answers.append((t, _pkg_files(t[:-6])))
+        elif t[-6:] == '-rdeps': answers.append((t, _pkg_rdeps(graph, t[:-6])))
+        elif t[-7:] == '-verify': answers.append((t, _pkg_verify(t[:-7])))
+    for path in args.owner or []: answers.append((path, _owner(path)))
+
+    if args.json:
+        print json.dumps(dict(answers), indent = 2, sort_keys = True)
+    else:
+        for query, answer in answers: _print_answer(query, answer)
+
+    sys.exit(1 if [a for q, a in answers if a is None or
+                   (q[-7:] == '-verify' and a)] else 0)
+
+
+def _info(graph):
+    """return all packages as [{name, mk, src, version, installed}]."""
+
+    from bomb.metadb import BosMetaDB
+
+    meta = BosMetaDB.packages()
+    info = []
+    for name in graph.names():
+        m = meta.get(name, (None,) * 6)
+        info.append({'name': name, 'mk': m[0], 'src': m[4], 'version': m[2],
+                     'installed': os.path.exists(
+                        os.path.join(Bos.statesdir, name + '.d'))})
+    return info
+
+
+def _pkg_info(name):
+    """return package as saved in metadata DB, None if unknown."""
+
+    from bomb.metadb import BosMetaDB
 
+    pkg = BosMetaDB.load(name)
+    return pkg.info() if pkg else None
+
+
+def _pkg_files(name):
+    """return installed files of package as [{path, mode, owner, size,
+    package}], package being the sub-package owning the file."""
+
+    from bomb.metadb import BosMetaDB
+
+    pkg = BosMetaDB.load(name)
+    if not pkg: return None
+    return sorted([{'path': c[3], 'mode': c[0], 'owner': c[1], 'size': c[2],
+                    'package': pn} for pn in pkg._contents
+                   for c in pkg._contents[pn]], key = lambda f: f['path'])
+
+
+def _pkg_rdeps(graph, name):
+    """return packages depending on package as [{name, direct}]."""
+
+    if name not in graph.rdeps: return None
+    return [{'name': pn, 'direct': pn in graph.rdeps[name]}
+            for pn in graph.dependents([name])]
+
+
+def _pkg_verify(name):
+    """
+    return problems of installed files of package as [{path, problem}],
+    package not installed or its .mk changed since being problems too,
+    None if unknown.
+    """
+
+    from bomb.metadb import BosMetaDB
+
+    pkg = BosMetaDB.load(name)
+    if not pkg: return None
+
+    ## saved contents are stale, package is reinstalled once .mk changed
+    try: mtime = os.path.getmtime(os.path.join(Bos.topdir, pkg.mk))
+    except OSError: mtime = None
+    if mtime != pkg._mtime:
+        return [{'path': pkg.mk, 'problem': 'changed since installed'}]
+    if not [pn for pn in pkg._contents if pkg._contents[pn]]:
+        return [{'path': None, 'problem': 'not installed'}]
+
+    return [{'path': path, 'problem': problem}
+            for path, problem in pkg.verify()]
+
+
+def _owner(path):
+    """
+    return packages owning path in output areas as {native, target}, path
+    is looked up in both areas unless it is within one of them.
+    """
+
+    from bomb.metadb import BosMetaDB
+
+    owner = {}
+    full = os.path.abspath(path)
+    for native, outdir in [(True, Bos.nativedir), (False, Bos.targetdir)]:
+        if full.startswith(outdir):
+            return {('native' if native else 'target'):
+                    BosMetaDB.owner(full[len(outdir):], native)}
+        owner['native' if native else 'target'] = BosMetaDB.owner(path, native)
+    return owner
+
+
+def _print_answer(query, answer):
+
+    if answer is None:
+        sys.stderr.write('%s: unknown package\n' % query)
+
+    elif query == 'info':
+        print '\nall buidable packages:\n%s' % ('-' * 80)
+
+        pkgs = sorted([p['name'] for p in answer])
+        if len(pkgs) % 2 != 0: pkgs.append(' ')
+        split = len(pkgs) / 2
+        l1 = pkgs[0:split]
+        l2 = pkgs[split:]
+        for key, value in zip(l1, l2): print '%-40s %s' % (key, value)
+        print
+
+    elif query[-5:] == '-info':
+        print '-' * 80
+        print '%-12s: %s' % ('NAME', answer['name'])
+        print '%-12s: %s' % ('DESCRIPTION', '\n\t'.join(answer['description'].split('\n')))
+        print '-' * 80
+        print '%-12s: %s' % ('MK', answer['mk'])
+        print '%-12s: %s' % ('SRC', answer['src'])
+        if answer['require']: print '%-12s: %s' % ('DEPEND', ' '.join(answer['require']))
+        print '%-12s: %s' % ('VERSION', answer['version'])
+        print '-' * 80
+
+        for pn, files in sorted(answer['contents'].items()):
+            print '\n%s:' % pn
+            for f in files:
+                print '\t%s %s %10s %s' % (f['mode'], f['owner'], f['size'], f['path'])
+        print
+
+    elif query[-6:] == '-files':
+        for f in answer: print f['path']
+
+    elif query[-6:] == '-rdeps':
+        for p in answer:
+            print '%-40s %s' % (p['name'], 'direct' if p['direct'] else 'indirect')
+        print '\n%s: %d packages depend on it' % (query[:-6], len(answer))
+
+    elif query[-7:] == '-verify':
+        for p in answer:
+            print '%s: %s' % (query[:-7], ': '.join(
+                [x for x in [p['path'], p['problem']] if x]))
+        print '\n%s: %s' % (query[:-7], '%d problems found' % len(answer)
+                             if answer else 'verified')
+
+    else:
+        for area, pn in sorted(answer.items()):
+            print '%s: %s: %s' % (query, area, pn or 'not owned')
+
+
+def _print_stats():
+
+    from bomb.stats import BosStats
+
+    phases = ['prepare', 'config', 'compile', 'install']
+    summary = BosStats.summary()
+
+    ## packages by total wall time of their latest build, slowest first
+    rows = []
+    for pn, runs in summary.items():
+        latest = [runs[ph][0] if ph in runs else (0, 0, 0, 0) for ph in phases]
+        total = sum([r[0] for r in latest])
+        cpu = sum([r[1] + r[2] for r in latest])
+        rss = max([r[3] for r in latest])
+        prev = None
+        if min([len(r) for r in runs.values()]) > 1:
+            prev = sum([r[1][0] for r in runs.values()])
+        rows.append((total, pn, latest, cpu, rss, prev))
+    rows.sort(reverse = True)
+
+    print '\nbuild time in seconds, latest build of each package:\n%s' % ('-' * 80)
+    print '%-24s %8s %8s %8s %8s %8s %8s %8s %6s' % tuple(
+        ['PACKAGE'] + [ph.upper()[:7] for ph in phases] +
+        ['TOTAL', 'CPU', 'RSS(MB)', 'PREV'])
+    for total, pn, latest, cpu, rss, prev in rows:
+        change = '%+.0f%%' % ((total - prev) * 100 / prev) if prev else '-'
+        print '%-24s %8.1f %8.1f %8.1f %8.1f %8.1f %8.1f %8.1f %6s' % tuple(
+            [pn] + [r[0] for r in latest] + [total, cpu, rss / 1024.0, change])
+    print '%-24s %44.1f' % ('TOTAL', sum([r[0] for r in rows]))
+
+    locks = [l for l in BosStats.locks() if l[2]]
+    if locks:
+        print '\nlock contention:\n%s' % ('-' * 80)
+        print '%-56s %7s %6s %8s' % ('LOCK', 'LOCKED', 'WAITED', 'WAIT(S)')
+        for lockfile, count, contended, wait in locks:
+            print '%-56s %7d %6d %8.1f' % (lockfile[-56:], count, contended, wait)
+
+    trace = os.path.join(Bos.logdir, 'trace-%s.json' % os.environ['_BOS_LOGID_'])
+    if BosStats.trace(trace): print '\nbuild trace at: %s' % trace
+
+    print
     sys.exit(0)
@@ -0,0 +1,219 @@
+# Copyright (C) 2012        SWOAG Technology
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import os, sys
+import cPickle as pickle
+
+from bomb.main import Bos
+from bomb.log import Blog
+from bomb.mkindex import BosMkIndex
+
+class BosDepGraph(object):
+    """
+    package dependency graph
+
+    built once by bootstrap, where every package is opened exactly once no
+    matter how many packages require it, and saved for other commands.
+    when rebuilt from the previous graph, only packages with changed .mk are
+    opened and parsed again. the graph is indexed both ways, by packages
+    required and by packages requiring.
+
+    typical usage:  graph = BosDepGraph.load()
+    """
+
+    def __init__(self):
+
+        self.require = {}   #{name: [required package names]}
+        self.rdeps = {}     #{name: [names of packages requiring it]}
+        self.mk = {}        #{name: mk}
+        self.toolchain = [] #toolchain packages, with their dependencies
+        self.packages = []  #all other packages, with their dependencies
+        self.mtime = {}     #{name: mk mtime}
+        self.reparsed = []  #packages parsed again when graph was built
+
+    @classmethod
+    def build(cls, toolchain, packages, previous = None):
+        """
+        build graph from toolchain and other package names, as configured
+        in distro, adding all packages they require.
+
+        previous: graph to reuse dependencies of unchanged packages from
+        """
+
+        graph = BosDepGraph()
+
+        added = set()
+        for names, members in [(toolchain, graph.toolchain),
+                               (packages, graph.packages)]:
+            todo = list(reversed(names))
+            while todo:
+                pn = todo.pop()
+                ## each package is opened once, and listed once: packages
+                ## required by toolchain are toolchain packages themselves
+                if pn in added: continue
+                added.add(pn)
+
+                Blog.debug("adding package: %s" % pn)
+                graph._add(pn, previous)
+                members.append(pn)
+                todo.extend(reversed(graph.require[pn]))
+
+        graph.check()
+        graph._index()
+        return graph
+
+    @classmethod
+    def load(cls, fatal = True):
+        """return graph saved by bootstrap, None if there is none and not fatal."""
+
+        try:
+            with open(os.path.join(Bos.cachedir, 'depgraph'), 'rb') as f:
+                graph = pickle.load(f)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            if fatal: Blog.fatal('unable to load dependencies, bootstrap required.')
+            return None
+
+        ## graph saved before reverse dependencies were indexed
+        if not hasattr(graph, 'rdeps'): graph._index()
+        return graph
+
+    def save(self):
+
+        fn = os.path.join(Bos.cachedir, 'depgraph')
+        with open(fn + '.tmp', 'wb') as f:
+            pickle.dump(self, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(fn + '.tmp', fn)
+
+    def _add(self, pn, previous):
+
+        from bomb.package import BosPackage
+
+        ## reuse previous parse result if .mk is the same file, unmodified
+        if previous and pn in previous.mtime:
+            mk = previous.mk[pn]
+            try: mtime = os.path.getmtime(os.path.join(Bos.topdir, mk))
+            except OSError: mtime = None
+            if mtime == previous.mtime[pn] and BosMkIndex.find(pn) == mk:
+                self.require[pn] = previous.require[pn]
+                self.mk[pn] = mk
+                self.mtime[pn] = mtime
+                return
+
+        Blog.debug("parsing package: %s" % pn)
+        pkg = BosPackage.open(pn)
+        self.require[pn] = list(pkg.require)
+        self.mk[pn] = pkg.mk
+        self.mtime[pn] = pkg._mtime
+        self.reparsed.append(pn)
+
+    def _index(self):
+        """index reverse dependencies."""
+
+        self.rdeps = dict((pn, []) for pn in self.names())
+        for pn in self.names():
+            for dep in self.require[pn]: self.rdeps[dep].append(pn)
+
+    def names(self):
+        """return all package names, toolchain packages first."""
+
+        return self.toolchain + self.packages
+
+    def dependents(self, names):
+        """
+        return all packages requiring any of given packages, directly or
+        through others, in the order of names().
+        """
+
+        found = set()
+        todo = list(names)
+        while todo:
+            for pn in self.rdeps.get(todo.pop(), []):
+                if pn in found: continue
+                found.add(pn)
+                todo.append(pn)
+        return [pn for pn in self.names() if pn in found]
+
+    def critical_path(self, durations):
+        """
+        return priority of every package for scheduling: its expected build
+        time plus that of the longest chain of packages requiring it, i.e.
+        the least time the build takes from its start on.
+
+        durations: {name: expected build time}, packages never built are
+        expected to take the median time of all others.
+        """
+
+        known = sorted(durations.values())
+        default = known[len(known) / 2] if known else 1.0
+
+        ## post-order walk up the graph, packages requiring a package are
+        ## prioritized before the package itself
+        prio = {}
+        for root in self.names():
+            stack = [root]
+            while stack:
+                pn = stack[-1]
+                if pn in prio:
+                    stack.pop()
+                    continue
+                todo = [r for r in self.rdeps[pn] if r not in prio]
+                if todo:
+                    stack.extend(todo)
+                    continue
+                stack.pop()
+                prio[pn] = durations.get(pn, default) + max(
+                    [prio[r] for r in self.rdeps[pn]] or [0])
+        return prio
+
+    def check(self):
+        """detect dependency cycles, fatal if there is one."""
+
+        ## iterative depth-first search, a package still on the path when
+        ## it is reached again closes a cycle
+        done = set()
+        for root in self.names():
+            if root in done: continue
+            path = [root]
+            onpath = set(path)
+            stack = [iter(self.require.get(root, []))]
+            while stack:
+                for dep in stack[-1]:
+                    if dep in onpath:
+                        cycle = path[path.index(dep):] + [dep]
+                        Blog.fatal('dependency cycle: %s' % ' -> '.join(cycle))
+                    if dep not in done:
+                        path.append(dep)
+                        onpath.add(dep)
+                        stack.append(iter(self.require.get(dep, [])))
+                        break
+                else:
+                    stack.pop()
+                    pn = path.pop()
+                    onpath.discard(pn)
+                    done.add(pn)
+
+    def write_deps(self, deps):
+        """
+        write make dependencies, one rule per package. packages depend on .c
+        state of packages they require, updated only when their installed
+        contents changed. .mk changes are found by package version check.
+        """
+
+        deps.write('D:=%sstates/\n\n' % Bos.cachedir)
+
+        for pn in self.names():
+            if self.require[pn]:
+                deps.write('%s $(D)%s.f:%s\n' % (pn, pn, ''.join(
+                    [' $(D)%s.c' % dep for dep in self.require[pn]])))
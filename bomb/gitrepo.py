@@ -0,0 +1,334 @@
+# Copyright (C) 2012        SWOAG Technology
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+git repository inspection without running git
+
+HEAD, loose refs, packed-refs and the index are read directly. results are
+cached per repository, many packages usually share one.
+"""
+
+import os, sys, stat, errno, struct, bisect, hashlib, threading
+
+from bomb.main import Bos
+
+_lock = threading.Lock()
+_toplevels = {} #{directory: toplevel or None}
+_versions = {}  #{gitdir: version}
+_indexes = {}   #{index file: (stat data, paths, entries)}
+
+## fixed part of index entry, up to flags
+_entry = struct.Struct('>10L20sH')
+
+def bos_git_toplevel(path):
+    """
+    return top-level directory of git working tree containing path, None
+    if path is not within a git working tree.
+    """
+
+    path = os.path.abspath(path)
+    if not os.path.isdir(path): return None
+
+    visited = []
+    top = None
+    while True:
+        with _lock:
+            if path in _toplevels:
+                top = _toplevels[path]
+                break
+        visited.append(path)
+        if os.path.exists(os.path.join(path, '.git')):
+            top = path
+            break
+        parent = os.path.dirname(path)
+        if parent == path: break
+        path = parent
+
+    with _lock:
+        for p in visited: _toplevels[p] = top
+    return top
+
+
+def bos_git_version(gitdir):
+    """
+    return version of git repository, relative to topdir
+
+    the version names the checked out commit the way 'git describe --all'
+    does when the commit is pointed to by a ref: annotated tags first, then
+    lightweight tags, then the checked out branch and any other ref. a commit
+    without ref is named by its object id.
+
+    version is 'unknown' if there is no repository.
+    """
+
+    if not gitdir: return 'unknown'
+
+    with _lock:
+        if gitdir in _versions: return _versions[gitdir]
+
+    try: version = _describe(os.path.join(Bos.topdir, gitdir))
+    except (IOError, OSError): version = None
+    if not version: version = 'unknown'
+
+    with _lock: _versions[gitdir] = version
+    return version
+
+
+def bos_git_fingerprint(gitdir, path = None):
+    """
+    return fingerprint of tracked files of git repository under path, both
+    relative to topdir, of all tracked files if no path given.
+
+    the fingerprint covers index entries of the files, i.e. their committed
+    and staged contents, and contents of files changed in the working tree.
+    changes are found the way 'git status' does: only files whose stat data
+    differs from the index, or is racily clean, are read. untracked files
+    are not covered.
+
+    fingerprint is 'unknown' if there is no repository.
+    """
+
+    if not gitdir: return 'unknown'
+
+    gitdir = os.path.join(Bos.topdir, gitdir)
+    if path:
+        path = os.path.relpath(os.path.join(Bos.topdir, path),
+                               os.path.dirname(gitdir))
+        if path == '.' or path.startswith('..'): path = None
+
+    try: fingerprint = _fingerprint(gitdir, path)
+    except (IOError, OSError, ValueError, struct.error): fingerprint = None
+    return fingerprint or 'unknown'
+
+
+def _resolve_gitdir(gitdir):
+    """
+    return (gitdir, common gitdir) of repository, where .git may be a file
+    pointing to the actual gitdir, as used by worktrees and submodules.
+    """
+
+    if os.path.isfile(gitdir):
+        line = open(gitdir).read().strip()
+        if not line.startswith('gitdir:'): return (None, None)
+        path = line[7:].strip()
+        gitdir = os.path.normpath(os.path.join(os.path.dirname(gitdir), path))
+
+    common = gitdir
+    if os.path.exists(os.path.join(gitdir, 'commondir')):
+        path = open(os.path.join(gitdir, 'commondir')).read().strip()
+        common = os.path.normpath(os.path.join(gitdir, path))
+    return (gitdir, common)
+
+
+def _read_refs(common):
+    """
+    return all refs of repository as {ref: (object id, annotated)}, where
+    object id of annotated tags is the commit they point to, if known.
+    """
+
+    refs = {}
+    annotated = set()
+
+    ## packed refs first, loose refs take precedence
+    try:
+        last = None
+        for line in open(os.path.join(common, 'packed-refs')):
+            line = line.strip()
+            if not line or line[0] == '#': continue
+            if line[0] == '^':
+                ## peeled annotated tag, points to actual commit
+                if last:
+                    refs[last] = line[1:]
+                    annotated.add(last)
+                continue
+            sha, last = line.split(' ', 1)
+            refs[last] = sha
+    except IOError: pass
+
+    refsdir = os.path.join(common, 'refs')
+    for r, d, f in os.walk(refsdir):
+        for fn in f:
+            ref = os.path.join(r, fn)[len(common) + 1:]
+            try: sha = open(os.path.join(r, fn)).read().strip()
+            except IOError: continue
+            if len(sha) == 40:
+                refs[ref] = sha
+                annotated.discard(ref)
+
+    return dict((ref, (refs[ref], ref in annotated)) for ref in refs)
+
+
+def _describe(gitdir):
+
+    gitdir, common = _resolve_gitdir(gitdir)
+    if not gitdir: return None
+
+    head = open(os.path.join(gitdir, 'HEAD')).read().strip()
+    refs = _read_refs(common)
+
+    branch = None
+    if head.startswith('ref:'):
+        branch = head[4:].strip()
+        if branch not in refs: return None ## unborn branch
+        sha = refs[branch][0]
+    else:
+        sha = head
+
+    best = None
+    for ref, (ref_sha, annotated) in refs.items():
+        if ref_sha != sha or not ref.startswith('refs/'): continue
+        if ref.startswith('refs/tags/'): prio = 3 if annotated else 2
+        elif ref == branch: prio = 1
+        else: prio = 0
+        if not best or prio > best[0] or (prio == best[0] and ref < best[1]):
+            best = (prio, ref)
+
+    if best: return best[1][5:]
+    return sha
+
+
+def _head(gitdir, common):
+    """return object id of checked out commit, None if there is none."""
+
+    head = open(os.path.join(gitdir, 'HEAD')).read().strip()
+    if not head.startswith('ref:'): return head
+
+    ref = head[4:].strip()
+    try: return open(os.path.join(common, ref)).read().strip()
+    except IOError: return _read_refs(common).get(ref, (None,))[0]
+
+
+def _fingerprint(gitdir, path):
+
+    top = os.path.dirname(gitdir)
+    gitdir, common = _resolve_gitdir(gitdir)
+    if not gitdir: return None
+
+    index = os.path.join(gitdir, 'index')
+    try: ist = os.stat(index)
+    except OSError as e:
+        if e.errno != errno.ENOENT: raise
+        return _head(gitdir, common) ## nothing checked out
+
+    paths, entries = _read_index(index, ist)
+
+    ## entries are sorted by path, those under path are a single range
+    prefix = path.strip('/') + '/' if path and path.strip('/') else ''
+    lo = bisect.bisect_left(paths, prefix)
+    hi = bisect.bisect_left(paths, prefix[:-1] + '0') if prefix else len(paths)
+
+    h = hashlib.sha1()
+    for name, mode, sha, mtime, size, flags in entries[lo:hi]:
+        h.update('%o %s\0%s%d' % (mode, name, sha, flags & 0x3000))
+
+        ## unmerged, gitlink or not checked out, nothing to compare with
+        if flags & 0x3000 or mode == 0160000 or flags & 0x40000000: continue
+
+        try: st = os.lstat(os.path.join(top, name))
+        except OSError as e:
+            if e.errno not in [errno.ENOENT, errno.ENOTDIR]: raise
+            h.update('\0deleted\0')
+            continue
+
+        ## file modified in the same second as index may still look clean
+        if (int(st.st_mtime) == mtime and st.st_size & 0xffffffff == size
+            and int(st.st_mtime) < int(ist.st_mtime)): continue
+
+        if stat.S_ISREG(st.st_mode) and (st.st_mode & 0100) != (mode & 0100):
+            h.update('\0mode %o\0' % st.st_mode)
+        blob = _blob(os.path.join(top, name), st)
+        if blob != sha: h.update('\0changed\0' + blob)
+
+    return h.hexdigest()
+
+
+def _read_index(index, st):
+    """
+    return (paths, entries) of index, where entries are [(path, mode, object
+    id, mtime, size, flags)] sorted by path, with extended flags in the high
+    half of flags. parsed index is cached as long as it is not rewritten.
+    """
+
+    key = (st.st_ino, st.st_mtime, st.st_size)
+    with _lock:
+        cached = _indexes.get(index)
+        if cached and cached[0] == key: return cached[1:]
+
+    data = open(index, 'rb').read()
+    sig, version, count = struct.unpack_from('>4sLL', data)
+    if sig != 'DIRC' or version not in [2, 3, 4]:
+        raise ValueError('%s: unsupported index version' % index)
+
+    paths = []
+    entries = []
+    pos = 12
+    name = ''
+    for i in xrange(count):
+        start = pos
+        f = _entry.unpack_from(data, pos)
+        flags = f[11]
+        pos += _entry.size
+        if flags & 0x4000 and version >= 3:
+            flags |= struct.unpack_from('>H', data, pos)[0] << 16
+            pos += 2
+
+        if version == 4:
+            ## path is prefix compressed against the previous one
+            strip, pos = _varint(data, pos)
+            end = data.index('\0', pos)
+            name = name[:len(name) - strip] + data[pos:end]
+            pos = end + 1
+        else:
+            end = data.index('\0', pos)
+            name = data[pos:end]
+            ## entry padded by 1 to 8 NUL to a multiple of 8 bytes
+            pos = start + ((end - start + 8) & ~7)
+
+        paths.append(name)
+        entries.append((name, f[6], f[10].encode('hex'), f[2], f[9], flags))
+
+    with _lock: _indexes[index] = (key, paths, entries)
+    return (paths, entries)
+
+
+def _varint(data, pos):
+    """return (value, position after) of offset encoded integer at pos."""
+
+    c = ord(data[pos])
+    pos += 1
+    value = c & 127
+    while c & 128:
+        c = ord(data[pos])
+        pos += 1
+        value = ((value + 1) << 7) | (c & 127)
+    return (value, pos)
+
+
+def _blob(path, st):
+    """return git object id of file contents, or of symlink target."""
+
+    h = hashlib.sha1()
+    if stat.S_ISLNK(st.st_mode):
+        target = os.readlink(path)
+        h.update('blob %d\0%s' % (len(target), target))
+        return h.hexdigest()
+
+    h.update('blob %d\0' % st.st_size)
+    with open(path, 'rb') as f:
+        while True:
+            buf = f.read(1 << 20)
+            if not buf: break
+            h.update(buf)
+    return h.hexdigest()
@@ -0,0 +1,130 @@
+# Copyright (C) 2012        SWOAG Technology
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import os, sys, re, errno, fcntl, select, subprocess
+
+from bomb.log import Blog
+from bomb.util import bos_mem_available
+
+class BosJobServer(object):
+    """
+    GNU make compatible jobserver
+
+    a pipe holding one token per job slot but one, the implicit slot of the
+    process owning the jobserver. the pipe is passed to all sub-processes
+    through MAKEFLAGS, so that top-level make, package makes and the native
+    scheduler all draw job slots from one budget.
+
+    typical usage:  BosJobServer.create(jobs).export()
+    """
+
+    ## memory expected to be used by one job
+    job_memory = 512 << 20
+
+    def __init__(self, rfd, wfd, jobs):
+
+        self.rfd = rfd
+        self.wfd = wfd
+        self.jobs = jobs
+
+        ## private non-blocking reader of the pipe, clients sharing the pipe
+        ## expect blocking reads on theirs
+        self.reader = os.open('/proc/self/fd/%d' % rfd, os.O_RDONLY | os.O_NONBLOCK)
+        fcntl.fcntl(self.reader, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+
+    @classmethod
+    def create(cls, jobs):
+        """create jobserver with given number of job slots."""
+
+        rfd, wfd = os.pipe()
+        os.write(wfd, '+' * (jobs - 1))
+        return BosJobServer(rfd, wfd, jobs)
+
+    @classmethod
+    def get(cls):
+        """return jobserver inherited through MAKEFLAGS, None if there is none."""
+
+        flags = os.environ.get('MAKEFLAGS', '')
+        m = re.search(r'--jobserver-(?:auth|fds)=(\d+),(\d+)', flags)
+        if not m: return None
+
+        rfd, wfd = int(m.group(1)), int(m.group(2))
+        try:
+            os.fstat(rfd)
+            os.fstat(wfd)
+        except OSError:
+            Blog.warn('jobserver not accessible, run as a recursive make recipe?')
+            return None
+
+        m = re.search(r'(?:^|\s)-j(\d+)', flags)
+        return BosJobServer(rfd, wfd, int(m.group(1)) if m else 0)
+
+    @classmethod
+    def default_jobs(cls):
+        """
+        return number of jobs the host affords: one per cpu not kept busy
+        already, as long as there is enough free memory.
+        """
+
+        import multiprocessing
+        jobs = multiprocessing.cpu_count()
+
+        try: jobs -= int(os.getloadavg()[0])
+        except OSError: pass
+
+        mem = bos_mem_available()
+        if mem: jobs = min(jobs, mem * 1024 / cls.job_memory)
+
+        return max(jobs, 1)
+
+    def export(self):
+        """pass jobserver to all sub-processes through MAKEFLAGS."""
+
+        flags = re.sub(r'(?:^|\s)(-j\d*|--jobserver-(?:auth|fds)=\S+)', '',
+                       os.environ.get('MAKEFLAGS', ''))
+        os.environ['MAKEFLAGS'] = ' -j%d --jobserver-%s=%d,%d%s' % (
+            self.jobs, _auth_option(), self.rfd, self.wfd, flags)
+
+    def acquire(self, timeout = 0):
+        """
+        take a job token, waiting for one up to timeout seconds.
+
+        return token, None if there is none available
+        """
+
+        try:
+            if timeout: select.select([self.reader], [], [], timeout)
+            return os.read(self.reader, 1) or None
+        except (OSError, select.error) as e:
+            if e.args[0] not in [errno.EAGAIN, errno.EINTR]: raise
+        return None
+
+    def release(self, token):
+        """give back job token."""
+
+        os.write(self.wfd, token)
+
+
+def _auth_option():
+    """return name of the jobserver option understood by make in use."""
+
+    ## make 4.2 renamed --jobserver-fds as --jobserver-auth
+    try:
+        out = subprocess.Popen(['make', '--version'],
+                               stdout = subprocess.PIPE).communicate()[0]
+        m = re.match(r'GNU Make (\d+)\.(\d+)', out)
+        if m and (int(m.group(1)), int(m.group(2))) < (4, 2): return 'fds'
+    except OSError: pass
+    return 'auth'
@@ -13,45 +13,63 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
-import os, sys, time
+import os, sys, time, errno, fcntl, threading
 from bomb.main import Bos, DontcareException
+from bomb.log import Blog
 
 class BosLockFile(object):
     """
-    platform independent lockfile
+    lockfile based on kernel file locks
+
+    waiting for the lock blocks in the kernel, unless a timeout is given.
+    the lock is released by the kernel when its holder exits, even if
+    killed, so a crashed holder never leaves a stale lock behind. locks
+    are exclusive, or shared among readers if requested.
+
+    time spent waiting for each lockfile is accumulated in 'stats'.
 
     typical usage:  with BosLockFile(lockfile) as lock: do_stuff()
     """
 
-    def __init__(self, name, timeout = -1, wait = .01):
+    ## {lockfile: [times locked, times contended, total wait in seconds]}
+    stats = {}
+    _stats_lock = threading.Lock()
+
+    def __init__(self, name, timeout = -1, wait = .01, shared = False):
         self.locked = False
+        self.name = name
         self.lockfile = os.path.join(Bos.cachedir, "%s.lock" % name)
         self.timeout = timeout
         self.wait = wait
+        self.shared = shared
 
     def lock(self):
-        start = time.time()
-        while True:
-            try:
-                self.fd = os.open(self.lockfile, os.O_CREAT|os.O_EXCL|os.O_RDWR)
-                break;
+        op = fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX
+        self.fd = os.open(self.lockfile, os.O_CREAT|os.O_RDWR, 0644)
 
-            except OSError as oe:
-                if oe.errno == os.errno.EEXIST:
-                    if (time.time() - start) < self.timeout:
-                        time.sleep(self.wait)
-                    elif self.timeout != -1:
-                        raise DontcareException('lock: %s timeout' % self.name)
-                else: raise
+        start = time.time()
+        contended = False
+        try:
+            fcntl.flock(self.fd, op | fcntl.LOCK_NB)
+        except IOError as e:
+            if e.errno not in [errno.EAGAIN, errno.EACCES]:
+                os.close(self.fd)
+                raise
+            contended = True
+            try: self._wait(op, start)
+            except:
+                os.close(self.fd)
+                raise
 
         self.locked = True
- 
+        self._record(contended, time.time() - start)
+
     def unlock(self):
         if self.locked:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
             os.close(self.fd)
-            os.unlink(self.lockfile)
             self.locked = False
- 
+
     def __del__(self):
         self.unlock()
 
@@ -61,3 +79,31 @@ class BosLockFile(object):
 
     def __exit__(self, type, value, traceback):
         if self.locked: self.unlock()
+
+    def _wait(self, op, start):
+
+        if self.timeout == -1:
+            fcntl.flock(self.fd, op)
+            return
+
+        while True:
+            if (time.time() - start) >= self.timeout:
+                raise DontcareException('lock: %s timeout' % self.name)
+            time.sleep(self.wait)
+            try:
+                fcntl.flock(self.fd, op | fcntl.LOCK_NB)
+                return
+            except IOError as e:
+                if e.errno not in [errno.EAGAIN, errno.EACCES]: raise
+
+    def _record(self, contended, waited):
+
+        with BosLockFile._stats_lock:
+            st = BosLockFile.stats.setdefault(self.lockfile, [0, 0, 0.0])
+            st[0] += 1
+            if contended:
+                st[1] += 1
+                st[2] += waited
+
+        if contended:
+            Blog.debug('lock: %s waited %.3fs' % (self.name, waited))
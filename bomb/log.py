@@ -13,12 +13,26 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
-import os, sys, time
+import os, sys, time, threading, atexit, weakref, fcntl
 
-##TODO: logging is not locked for multi-process access, but do we care?
 class BosLog(object):
+    """
+    buffered log file
 
-    def __init__(self, name = None, sync = False, quiet = False, timestamp = True):
+    messages are buffered in process and written out by a background
+    flusher at most 'latency' seconds later, or at once when the buffer
+    grows beyond 'bufsize', the log is in sync mode, or on errors. each
+    write appends the whole buffer under an exclusive file lock, so that
+    parallel jobs can share one log.
+
+    compressed logs are written gzip'ed, with '.gz' added to log name.
+    """
+
+    latency = .5
+    bufsize = 1 << 16
+
+    def __init__(self, name = None, sync = False, quiet = False, timestamp = True,
+                 compress = False):
         if not name: name = 'summary-%s' % os.environ['_BOS_LOGID_']
 
         self.name = os.path.join(os.environ['_BOS_LOGDIR_'], name)
@@ -27,27 +41,137 @@ class BosLog(object):
         self.timestamp = timestamp
 
         dn = os.path.dirname(self.name)
-        if not os.path.exists(dn): os.makedirs(dn)
-        self.log = open(self.name, 'a')
+        if not os.path.exists(dn):
+            try: os.makedirs(dn)
+            except OSError: pass ## created by parallel job
+
+        if compress:
+            import gzip
+            self.name += '.gz'
+            self.log = gzip.GzipFile(self.name, 'ab')
+        else:
+            self.log = os.fdopen(os.open(self.name,
+                                         os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                                         0644), 'ab', 0)
+
+        self.buf = []
+        self.buflen = 0
+        self.lock = threading.Lock()
+        _flusher.add(self)
 
     def info(self, msg):
 
         if self.timestamp: msg = '%s %s' % (time.strftime('%X'), msg.rstrip())
         else: msg = msg.rstrip()
 
-        self.log.write('%s\n' % msg)
-        if self.sync: self.log.flush()
+        self._append('%s\n' % msg)
+
+        if False == self.quiet: print msg
+
+    def write(self, lines):
+        """log multiple lines in one go."""
+
+        if self.timestamp:
+            ts = time.strftime('%X')
+            lines = ['%s %s' % (ts, l.rstrip()) for l in lines]
+        else: lines = [l.rstrip() for l in lines]
+
+        msg = '\n'.join(lines)
+        self._append('%s\n' % msg)
 
         if False == self.quiet: print msg
 
+    def flush(self):
+        """write out buffered messages."""
+
+        with self.lock:
+            if not self.buf or self.log.closed: return
+            data = ''.join(self.buf)
+            self.buf = []
+            self.buflen = 0
+
+            fcntl.flock(self.log.fileno(), fcntl.LOCK_EX)
+            try:
+                self.log.write(data)
+                self.log.flush()
+            finally:
+                fcntl.flock(self.log.fileno(), fcntl.LOCK_UN)
+
+    def close(self):
+        self.flush()
+        _flusher.remove(self)
+        ## not while flusher writes it
+        with self.lock: self.log.close()
+
+    def __del__(self):
+        try: self.close()
+        except: pass
+
+    def _append(self, data):
+
+        with self.lock:
+            self.buf.append(data)
+            self.buflen += len(data)
+            full = self.buflen >= self.bufsize
+
+        if full or self.sync: self.flush()
+
     def debug(self, msg):
         if os.environ['_BOS_DEBUG_'] == 'yes': self.info(msg)
 
     def warn(self, msg):
         self.info('WARNING: ' + msg)
+        self.flush()
 
     def error(self, msg):
         self.info('ERROR: ' + msg)
+        self.flush()
+
+
+class _BosLogFlusher(object):
+    """background flusher of all open logs, flushes them all at exit too."""
+
+    def __init__(self):
+
+        self.logs = weakref.WeakSet()
+        self.lock = threading.Lock()
+        self.thread = None
+        atexit.register(self.flush)
+
+    def add(self, log):
+
+        with self.lock:
+            self.logs.add(log)
+            if not self.thread or self.thread.pid != os.getpid():
+                self.thread = threading.Thread(target = self._run)
+                self.thread.pid = os.getpid()
+                self.thread.daemon = True
+                self.thread.start()
+
+    def remove(self, log):
+
+        with self.lock: self.logs.discard(log)
+
+    def flush(self):
+
+        with self.lock: logs = list(self.logs)
+        for log in logs: log.flush()
+
+    def _run(self):
+
+        while True:
+            try:
+                time.sleep(BosLog.latency)
+                with self.lock: logs = list(self.logs)
+            except: return ## interpreter shutting down
+
+            ## a failed write, e.g. on a full disk, loses its messages but
+            ## neither other logs nor later writes
+            for log in logs:
+                try: log.flush()
+                except Exception: pass
+
+_flusher = _BosLogFlusher()
 
 
 class Blog():
@@ -56,39 +180,39 @@ class Blog():
 
     @classmethod
     def info(cls, msg):
-        if not cls.log: cls.log = BosLog(sync = True)
+        if not cls.log: cls.log = BosLog()
         return cls.log.info(msg)
 
     @classmethod
     def warn(cls, msg):
-        if not cls.log: cls.log = BosLog(sync = True)
+        if not cls.log: cls.log = BosLog()
         return cls.log.warn(msg)
 
     @classmethod
     def error(cls, msg):
-        if not cls.log: cls.log = BosLog(sync = True)
+        if not cls.log: cls.log = BosLog()
         return cls.log.error(msg)
 
     @classmethod
     def debug(cls, msg):
         if os.environ['_BOS_DEBUG_'] == 'yes':
             import inspect
-            if not cls.log: cls.log = BosLog(sync = True)
+            if not cls.log: cls.log = BosLog()
             return cls.log.debug('[%s] %s' % (inspect.stack()[1][3], msg))
 
     @classmethod
     def name(cls):
-        if not cls.log: cls.log = BosLog(sync = True)
+        if not cls.log: cls.log = BosLog()
         return cls.log.name
 
     @classmethod
     def fatal(cls, msg):
-        if not cls.log: cls.log = BosLog(sync = True)
+        if not cls.log: cls.log = BosLog()
         cls.log.error(msg)
         print ''
         raise Exception(msg)
 
     @classmethod
     def get_log(cls):
-        if not cls.log: cls.log = BosLog(sync = True)
+        if not cls.log: cls.log = BosLog()
         return cls.log
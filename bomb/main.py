@@ -32,12 +32,15 @@ class Bos(object):
     nativedir = outdir + 'native/'
     targetdir = outdir + 'target/'
     metadir = outdir + 'meta/'
-    nativeindexdir = metadir + 'index/native/'
-    targetindexdir = metadir + 'index/target/'
-    shelvedir = metadir + 'shelve/'
+    stagingdir = outdir + 'staging/' ## same filesystem as output area
+    nativeindexdir = metadir + 'index/native/' ## obsolete, replaced by metadb
+    targetindexdir = metadir + 'index/target/' ## obsolete, replaced by metadb
+    shelvedir = metadir + 'shelve/' ## obsolete, replaced by metadb
+    metadb = metadir + 'bos.db'
     mkdir = metadir + 'mk/'
 
     logdir = builddir + 'logs/'
+    pkgcachedir = builddir + 'pkgcache/'
     distrodir = topdir + 'distro/'
 
     ## big global lock to protect writing to/removing from output area
@@ -46,12 +49,12 @@ class Bos(object):
 
     native_env = {}
     target_env = {}
+    _saved_env = None
 
     @classmethod
     def setup(cls):
 
-        for d in [cls.shelvedir, cls.statesdir, cls.mkdir,
-                  cls.nativeindexdir, cls.targetindexdir,
+        for d in [cls.metadir, cls.statesdir, cls.mkdir,
                   cls.logdir, cls.nativedir, cls.targetdir]:
             dd = os.path.join(cls.topdir, d)
             if not os.path.exists(dd): os.makedirs(dd)
@@ -75,22 +78,48 @@ class Bos(object):
 
     @classmethod
     def save_env(cls):
+        """
+        save native and target build env.
+
+        return list of build envs changed since saved before, as native
+        flags: True for native, False for target
+        """
 
         import shelve
         db = shelve.open(os.path.join(cls.cachedir, 'bos-build-env'))
+        changed = [native for native, env in [(True, cls.native_env),
+                                              (False, cls.target_env)]
+                   if db.get('native' if native else 'target') != env]
         db['native'] = cls.native_env
         db['target'] = cls.target_env
         db.close()
+        return changed
 
     @classmethod
     def get_env(cls, native = False):
+        """
+        return process environment updated with native or target build env.
 
-        import shelve
+        build env is loaded once per process, os.environ is left untouched
+        so that packages of both kinds can be built from the same process.
+        """
 
-        db = shelve.open(os.path.join(cls.cachedir, 'bos-build-env'))
-        env = db['native'] if native else db['target']
+        env = dict(os.environ)
+        env.update(cls.load_env(native))
         #print 'got env: {0}'.format(env)
-        os.environ.update(env)
+        return env
+
+    @classmethod
+    def load_env(cls, native = False):
+        """return native or target build env as saved by bootstrap."""
+
+        if not cls._saved_env:
+            import shelve
+            db = shelve.open(os.path.join(cls.cachedir, 'bos-build-env'))
+            cls._saved_env = {'native': db['native'], 'target': db['target']}
+            db.close()
+
+        return cls._saved_env['native'] if native else cls._saved_env['target']
 
     @classmethod
     def set_env(cls, env, native = False):
@@ -0,0 +1,112 @@
+# Copyright (C) 2012        SWOAG Technology
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import os, sys, time, errno, threading
+import cPickle as pickle
+from contextlib import contextmanager
+
+from bomb.main import Bos
+from bomb.log import Blog
+from bomb.lockfile import BosLockFile
+
+class BosMemBudget(object):
+    """
+    memory admission control of package phases
+
+    a phase is admitted to run when the peak RSS it is expected to reach,
+    as learned from previous builds, fits into the memory budget together
+    with expected peaks of all phases running already, otherwise it waits.
+    a phase is always admitted when nothing else runs.
+
+    running phases of all build processes are recorded in a ledger under
+    Bos.cachedir. the budget is given in KB by bosm as _BOS_MEMBUDGET_, no
+    budget or 0 disables admission control.
+
+    typical usage:  with BosMemBudget.admit(name, peak): do_phase()
+    """
+
+    poll = 1
+
+    @classmethod
+    def budget(cls):
+        """return memory budget in KB, 0 if there is none."""
+
+        return int(os.environ.get('_BOS_MEMBUDGET_') or 0)
+
+    @classmethod
+    def fits(cls, peaks, peak):
+        """return True if peak fits into budget, together with given peaks."""
+
+        budget = cls.budget()
+        return not budget or not peaks or sum(peaks) + peak <= budget
+
+    @classmethod
+    @contextmanager
+    def admit(cls, name, peak):
+        """wait until expected peak RSS of named phase fits into budget."""
+
+        if not cls.budget() or not peak:
+            yield
+            return
+
+        key = '%d.%d' % (os.getpid(), threading.current_thread().ident)
+        waited = False
+        while True:
+            with BosLockFile('membudget') as lock:
+                ledger = _load()
+                if cls.fits([p for n, p in ledger.values()], peak):
+                    ledger[key] = (name, peak)
+                    _save(ledger)
+                    break
+
+            if not waited:
+                Blog.info('%s waiting for memory, %dMB expected'
+                          % (name, peak / 1024))
+                waited = True
+            time.sleep(cls.poll)
+
+        try:
+            yield
+        finally:
+            with BosLockFile('membudget') as lock:
+                ledger = _load()
+                ledger.pop(key, None)
+                _save(ledger)
+
+
+def _ledger_name():
+
+    return os.path.join(Bos.cachedir, 'membudget')
+
+
+def _load():
+    """return ledger of running phases, of live processes only."""
+
+    try:
+        with open(_ledger_name(), 'rb') as f: ledger = pickle.load(f)
+    except (IOError, EOFError, pickle.UnpicklingError):
+        return {}
+
+    for key in ledger.keys():
+        try: os.kill(int(key.split('.')[0]), 0)
+        except OSError as e:
+            if e.errno == errno.ESRCH: del ledger[key]
+    return ledger
+
+
+def _save(ledger):
+
+    with open(_ledger_name(), 'wb') as f:
+        pickle.dump(ledger, f, pickle.HIGHEST_PROTOCOL)
@@ -0,0 +1,224 @@
+# Copyright (C) 2012        SWOAG Technology
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import os, sys, shutil, threading, sqlite3
+import cPickle as pickle
+from contextlib import contextmanager
+
+from bomb.main import Bos
+
+class BosMetaDB(object):
+    """
+    package metadata database
+
+    a single SQLite database under Bos.metadir holding every package, its
+    .mk, version and installed contents. packages are stored pickled,
+    together with the fields needed by batch queries, so that scanning all
+    packages does not require unpickling any of them.
+
+    the database also holds the ownership index of output areas, mapping
+    each installed path to the package owning it and back, and build stats.
+
+    the database runs in WAL mode and all writes are done in immediate
+    transactions, so it is safe to share between parallel build processes.
+    one connection is kept per thread.
+
+    typical usage:  with BosMetaDB.transaction() as db: db.execute(...)
+    """
+
+    _local = threading.local()
+
+    _schema = [
+        'CREATE TABLE IF NOT EXISTS packages ('
+        '  name TEXT PRIMARY KEY, mk TEXT, mtime REAL,'
+        '  version TEXT, gitdir TEXT, obj BLOB, src TEXT, patches TEXT)',
+        'CREATE TABLE IF NOT EXISTS owners ('
+        '  area TEXT, path TEXT, package TEXT,'
+        '  PRIMARY KEY (area, path))',
+        'CREATE INDEX IF NOT EXISTS owners_package ON owners (area, package)',
+        'CREATE TABLE IF NOT EXISTS stats ('
+        '  id INTEGER PRIMARY KEY, build TEXT, package TEXT, phase TEXT,'
+        '  start REAL, wall REAL, utime REAL, stime REAL, maxrss INTEGER,'
+        '  ret INTEGER)',
+        'CREATE INDEX IF NOT EXISTS stats_package ON stats (package, phase)',
+        'CREATE TABLE IF NOT EXISTS lockstats ('
+        '  build TEXT, lockfile TEXT, count INTEGER, contended INTEGER,'
+        '  wait REAL, PRIMARY KEY (build, lockfile))',
+    ]
+
+    @classmethod
+    def connect(cls):
+        """return database connection of calling thread."""
+
+        db = getattr(cls._local, 'db', None)
+        if not db or cls._local.pid != os.getpid():
+            db = sqlite3.connect(Bos.metadb, timeout = 600,
+                                 isolation_level = None)
+            db.text_factory = str
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            for sql in cls._schema: db.execute(sql)
+            cls._local.db = db
+            cls._local.pid = os.getpid()
+            cls._migrate_packages(db)
+            cls._migrate_index(db)
+        return db
+
+    @classmethod
+    @contextmanager
+    def reading(cls):
+        """
+        read-only connection of calling thread for the duration, database is
+        neither created, nor its schema set up or migrated.
+        """
+
+        db = sqlite3.connect(Bos.metadb, timeout = 600, isolation_level = None)
+        db.text_factory = str
+        db.execute('PRAGMA query_only=ON')
+        cls._local.db = db
+        cls._local.pid = os.getpid()
+        try:
+            yield db
+        finally:
+            cls._local.db = None
+            db.close()
+
+    @classmethod
+    @contextmanager
+    def transaction(cls):
+        """write transaction, committed on success and rolled back on error."""
+
+        db = cls.connect()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            yield db
+        except:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+    @classmethod
+    def load(cls, name):
+        """return package with given name, None if not found."""
+
+        row = cls.connect().execute(
+            'SELECT obj FROM packages WHERE name = ?', (name,)).fetchone()
+        return pickle.loads(str(row[0])) if row else None
+
+    @classmethod
+    def save(cls, pkg):
+        """save package, replacing any previously saved one."""
+
+        obj = sqlite3.Binary(pickle.dumps(pkg, pickle.HIGHEST_PROTOCOL))
+        with cls.transaction() as db:
+            db.execute('INSERT OR REPLACE INTO packages'
+                       ' (name, mk, mtime, version, gitdir, obj, src, patches)'
+                       ' VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                       (pkg.name, pkg.mk, pkg._mtime, pkg._version,
+                        pkg._gitdir, obj, pkg._src, ' '.join(pkg._patch)))
+
+    @classmethod
+    def packages(cls):
+        """
+        return all packages as {name: (mk, mtime, version, gitdir, src,
+        patches)}, patches None if saved by an older release.
+        """
+
+        return dict((r[0], r[1:6] + (None if r[6] is None else r[6].split(),))
+                    for r in cls.connect().execute(
+                        'SELECT name, mk, mtime, version, gitdir, src, patches'
+                        ' FROM packages'))
+
+    @classmethod
+    def owner(cls, path, native = False):
+        """return package owning path of output area, None if not owned."""
+
+        row = cls.connect().execute(
+            'SELECT package FROM owners WHERE area = ? AND path = ?',
+            (_area(native), path.lstrip('/'))).fetchone()
+        return row[0] if row else None
+
+    @classmethod
+    def add_owner(cls, name, paths, native = False):
+        """record package name as owner of given output area paths."""
+
+        area = _area(native)
+        with cls.transaction() as db:
+            db.executemany('INSERT OR REPLACE INTO owners (area, path, package)'
+                           ' VALUES (?, ?, ?)',
+                           [(area, p.lstrip('/'), name) for p in paths])
+
+    @classmethod
+    def remove_owner(cls, name, paths = None, native = False):
+        """
+        remove given paths owned by package name from ownership index,
+        all paths owned by it if paths is None.
+        """
+
+        area = _area(native)
+        with cls.transaction() as db:
+            if paths is None:
+                db.execute('DELETE FROM owners WHERE area = ? AND package = ?',
+                           (area, name))
+            else:
+                db.executemany('DELETE FROM owners'
+                               ' WHERE area = ? AND path = ? AND package = ?',
+                               [(area, p.lstrip('/'), name) for p in paths])
+
+    @classmethod
+    def _migrate_packages(cls, db):
+        """add columns missing in packages table of older releases."""
+
+        columns = [r[1] for r in db.execute('PRAGMA table_info(packages)')]
+        for col in ['src', 'patches']:
+            if col in columns: continue
+            ## may be added by a parallel job meanwhile
+            try: db.execute('ALTER TABLE packages ADD COLUMN %s TEXT' % col)
+            except sqlite3.OperationalError: pass
+
+    @classmethod
+    def _migrate_index(cls, db):
+        """import and remove obsolete ownership index of one symlink per path."""
+
+        for native in [True, False]:
+            indexdir = Bos.nativeindexdir if native else Bos.targetindexdir
+            if not os.path.isdir(indexdir): continue
+
+            dirlen = len(indexdir)
+            rows = []
+            for r, d, f in os.walk(indexdir):
+                for fn in f + [dn for dn in d if os.path.islink(os.path.join(r, dn))]:
+                    path = os.path.join(r, fn)
+                    try: rows.append((_area(native), path[dirlen:], os.readlink(path)))
+                    except OSError: pass
+
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                db.executemany('INSERT OR IGNORE INTO owners (area, path, package)'
+                               ' VALUES (?, ?, ?)', rows)
+            except:
+                db.execute('ROLLBACK')
+                raise
+            db.execute('COMMIT')
+
+            ## migrated index may be removed by a parallel job meanwhile
+            shutil.rmtree(indexdir, ignore_errors = True)
+            try: os.rmdir(os.path.dirname(indexdir.rstrip('/')))
+            except OSError: pass
+
+
+def _area(native):
+
+    return 'native' if native else 'target'
@@ -0,0 +1,118 @@
+# Copyright (C) 2012        SWOAG Technology
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import os, sys
+import cPickle as pickle
+
+from bomb.main import Bos
+from bomb.log import Blog
+
+class BosMkIndex(object):
+    """
+    persistent package name to .mk path index
+
+    the index remembers every directory under the bm/ trees together with
+    its mtime, the .mk files and sub-directories it contains. a directory is
+    only re-listed when its mtime changed, so resolving a package .mk is a
+    dictionary lookup once the index is loaded.
+
+    typical usage:  mkpath = BosMkIndex.lookup(name, basename)
+    """
+
+    _index = None
+
+    def __init__(self):
+
+        self.fname = os.path.join(Bos.metadir, 'mkindex')
+        self.dirs = {}  #{dir: (mtime, [mk files], [sub dirs])}
+        self.names = [] #[{name: mk path}] per bm/ root, in search order
+        self.dirty = False
+
+        try:
+            with open(self.fname, 'rb') as f: self.dirs = pickle.load(f)
+        except: self.dirs = {}
+
+        self._refresh()
+        if self.dirty: self._save()
+
+    @classmethod
+    def lookup(cls, name, basename = None):
+        """
+        return .mk path for given package name, None if not found.
+
+        distro/bm is searched before topdir/bm; within one root an exact
+        name match wins over basename match, used by -native packages.
+        """
+
+        if not cls._index: cls._index = BosMkIndex()
+
+        for names in cls._index.names:
+            if name in names: return names[name]
+            if basename and basename in names: return names[basename]
+        return None
+
+    @classmethod
+    def find(cls, name):
+        """return .mk path of given package relative to topdir, None if not found."""
+
+        mkpath = cls.lookup(name, name[:-7] if name[-7:] == '-native' else None)
+        if mkpath: return mkpath[len(Bos.topdir):]
+        return mkpath
+
+    def _refresh(self):
+
+        seen = {}
+        for root in [os.path.join(Bos.distrodir, 'bm'),
+                     os.path.join(Bos.topdir, 'bm')]:
+            names = {}
+            self._scan(root, names, seen)
+            self.names.append(names)
+
+        if len(seen) != len(self.dirs): self.dirty = True
+        self.dirs = seen
+
+    def _scan(self, path, names, seen):
+
+        try: mtime = os.stat(path).st_mtime
+        except OSError: return
+
+        entry = self.dirs.get(path)
+        if not entry or entry[0] != mtime:
+            Blog.debug('mk index updating: %s' % path)
+            mks = []
+            subdirs = []
+            for fn in sorted(os.listdir(path)):
+                p = os.path.join(path, fn)
+                if os.path.isdir(p):
+                    if not os.path.islink(p): subdirs.append(p)
+                elif fn.endswith('.mk'): mks.append(fn)
+
+            entry = (mtime, mks, subdirs)
+            self.dirty = True
+
+        seen[path] = entry
+        for fn in entry[1]: names.setdefault(fn[:-3], os.path.join(path, fn))
+        for d in entry[2]: self._scan(d, names, seen)
+
+    def _save(self):
+
+        ## write and rename, so that concurrent readers never see partial index
+        tmp = '%s.%d' % (self.fname, os.getpid())
+        try:
+            with open(tmp, 'wb') as f:
+                pickle.dump(self.dirs, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp, self.fname)
+        except (IOError, OSError) as e:
+            Blog.warn('unable to save mk index: %s' % e)
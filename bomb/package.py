@@ -13,14 +13,22 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
-import os, sys, glob, shutil
+import os, sys, re, glob, shutil, bisect, errno, hashlib
+from fnmatch import fnmatchcase
 import shelve
 from ConfigParser import ConfigParser, NoOptionError, ParsingError
+from StringIO import StringIO
 
 from bomb.main import Bos
 from bomb.log import Blog
-from bomb.util import bos_run, bos_rm_empty_path, bos_fileinfo
+from bomb.util import bos_run, bos_rm_empty_path, bos_fileinfo, bos_install_file
+from bomb.util import bos_scan_tree, bos_write_changed
+from bomb.gitrepo import bos_git_toplevel, bos_git_fingerprint
 from bomb.lockfile import BosLockFile
+from bomb.mkindex import BosMkIndex
+from bomb.pkgcache import BosPkgCache
+from bomb.metadb import BosMetaDB
+from bomb.stats import BosStats
 
 class BosInstallContext(object):
 
@@ -31,18 +39,71 @@ class BosInstallContext(object):
         if pkg._native:
             self.name = name + '-native'
             self.destdir = Bos.nativedir
-            self.indexdir = Bos.nativeindexdir
         else:
             self.name = name
             self.destdir = Bos.targetdir
-            self.indexdir = Bos.targetindexdir
 
-        self.baselen = len(pkg._get_stagingdir())
-        self.contents = [] #[mode owner size path]
+        self.files = [] #[(staging path, path relative to destdir)]
+        self.contents = [] #[mode owner size path mtime digest]
+
+
+class BosStagingManifest(object):
+    """
+    all files in staging area, listed in one traversal together with their
+    lstat results, and matched against package file patterns in memory.
+    """
+
+    def __init__(self, stagingdir, jobs = 4):
+
+        self.files, dirs = bos_scan_tree(stagingdir, jobs)
+        self.dirs = set(dirs)
+        self.sorted = sorted(self.files)
+
+        self.depths = {} #{depth: [files and directories]}
+        for path in self.sorted + dirs:
+            self.depths.setdefault(path.count('/') + 1, []).append(path)
+
+    def match(self, pattern):
+        """return files and directories matching glob pattern, like glob."""
+
+        parts = pattern.strip('/').split('/')
+        if not glob.has_magic(pattern):
+            path = '/'.join(parts)
+            return [path] if path in self.files or path in self.dirs else []
+
+        ## as glob, wildcards do not match hidden names
+        matched = []
+        for path in self.depths.get(len(parts), []):
+            for name, part in zip(path.split('/'), parts):
+                if not fnmatchcase(name, part): break
+                if name[0] == '.' and part[0] != '.': break
+            else:
+                matched.append(path)
+        return matched
+
+    def expand(self, path):
+        """return given file, or all files under given directory."""
+
+        if path not in self.dirs: return [path]
+
+        prefix = path + '/'
+        i = bisect.bisect_left(self.sorted, prefix)
+        files = []
+        while i < len(self.sorted) and self.sorted[i].startswith(prefix):
+            files.append(self.sorted[i])
+            i += 1
+        return files
 
 
 class BosPackage(object):
 
+    ## defaults for packages put on shelf before binary package cache
+    _cached = None
+    _cachekey = None
+    ## defaults for packages saved before early cutoff
+    _signature = None
+    changed = True
+
     def __init__(self, name):
 
         self.name = name
@@ -59,14 +120,21 @@ class BosPackage(object):
         mk_full_path = os.path.join(Bos.topdir, self.mk)
 
         Blog.debug('start to parse .mk: %s' % self.mk)
+        header, makefile, phases = _parse_mk(mk_full_path)
+        bos_write_changed(os.path.join(Bos.mkdir, os.path.basename(self.mk)), makefile)
+
+        self.prepare_yes = 'prepare' in phases
+        self.config_yes = 'config' in phases
+        self.compile_yes = 'compile' in phases
+        self.install_yes = 'install' in phases
+        self.clean_yes = 'clean' in phases
+
         config = ConfigParser()
-        meta = self._preprocess_mk()
         try:
-            config.read(meta)
+            config.readfp(StringIO(header), self.mk)
         except ParsingError as e:
             Blog.error(e.message)
             Blog.fatal("failed to parse .mk:  %s <%s>" % (name, self.mk))
-        os.remove(meta)
 
         Blog.debug('parsing package .mk: %s' % self.mk)
         ## package description is required
@@ -115,87 +183,156 @@ class BosPackage(object):
         self._contents = {}
         ## version info is available only after a successful install.
         self._version = None
-
-        ## put it on shelf
-        db = shelve.open(_get_shelf_name(name))
-        db['obj'] = self
-        db.close()
+        ## binary package cache key, if package is to be restored from cache.
+        self._cached = None
+        ## cache key as looked up, before patches are applied, to store under.
+        self._cachekey = None
+        ## digest of installed contents as observable by dependents, kept
+        ## over uninstall so that an identical reinstall is not a change.
+        self._signature = None
+        self.changed = True
+
+        ## put it in metadata DB
+        self._flush()
 
     @classmethod
     def open(cls, name):
 
-        try:
-            db = shelve.open(_get_shelf_name(name))
-            pkg = db['obj']
-            Blog.debug('package: %s already on shelve' % name)
-            if os.path.getmtime(os.path.join(Bos.topdir, pkg.mk)) != pkg._mtime:
+        pkg = BosMetaDB.load(name)
+        if not pkg: pkg = _load_shelf(name)
+
+        signature = None
+        if pkg:
+            Blog.debug('package: %s already in metadata DB' % name)
+            mtime = os.path.getmtime(os.path.join(Bos.topdir, pkg.mk))
+            if mtime == pkg._mtime: pass
+            elif pkg._version and pkg._get_version() == pkg._version:
+                ## .mk touched only, package inputs are unchanged
+                pkg._mtime = mtime
+                pkg._flush()
+            else:
                 pkg._uninstall()
+                signature = pkg._signature
                 pkg = None
 
-        except KeyError: pkg = None
-
-        if not pkg: return BosPackage(name)
+        if not pkg:
+            pkg = BosPackage(name)
+            ## .mk changes do not necessarily change installed contents
+            if signature:
+                pkg._signature = signature
+                pkg._flush()
         return pkg
 
+    @classmethod
+    def versions(cls, inputs, jobs = 8):
+        """
+        return versions of packages given as {name: (mk, patches, gitdir,
+        src)}, fingerprinted on a pool of threads in parallel.
+        """
+
+        names = inputs.keys()
+        if len(names) > 1 and jobs > 1:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(min(jobs, len(names)))
+            try: versions = pool.map(lambda n: _fingerprint(*inputs[n]), names)
+            finally: pool.close()
+        else:
+            versions = [_fingerprint(*inputs[n]) for n in names]
+
+        return dict(zip(names, versions))
+
     def is_version_diff(self):
         return (False if self._get_version() == self._version else True)
 
 
+    @BosStats.phase('prepare')
     def prepare(self):
 
         Blog.info("preparing %s" % self.name)
+        if self._cache_lookup():
+            Blog.info("%s found in package cache" % self.name)
+            return (0, None)
+
         self._apply_patch()
 
         if self.prepare_yes:
-            Bos.get_env(self._native)
             return bos_run(['make', '-C', os.path.join(Bos.topdir, self._src),
                             '-f', os.path.join(Bos.mkdir, os.path.basename(self.mk)),
                             '--no-print-directory',
                             'MK=%s' % os.path.dirname(os.path.join(Bos.topdir, self.mk)),
-                            'prepare'], self._get_logdir() + '-prepare')
+                            'prepare'], self._get_logdir() + '-prepare',
+                           env = Bos.get_env(self._native))
         return (0, None)
 
+    @BosStats.phase('config')
     def config(self):
 
-        if self.config_yes:
+        if self.config_yes and not self._cached:
             Blog.info("configuring %s" % self.name)
-            Bos.get_env(self._native)
             return bos_run(['make', '-C', os.path.join(Bos.topdir, self._src),
                             '-f', os.path.join(Bos.mkdir, os.path.basename(self.mk)),
                             '--no-print-directory',
-                            'config'], self._get_logdir() + '-config')
+                            'config'], self._get_logdir() + '-config',
+                           env = Bos.get_env(self._native))
         return (0, None)
 
+    @BosStats.phase('compile')
     def compile(self):
 
-        if self.compile_yes:
+        if self.compile_yes and not self._cached:
             Blog.info("compiling %s" % self.name)
-            Bos.get_env(self._native)
             return bos_run(['make', '-C', os.path.join(Bos.topdir, self._src),
                             '-f', os.path.join(Bos.mkdir, os.path.basename(self.mk)),
                             '--no-print-directory',
-                            'compile'], self._get_logdir() + '-compile')
+                            'compile'], self._get_logdir() + '-compile',
+                           env = Bos.get_env(self._native))
         return (0, None)
 
+    @BosStats.phase('install')
     def install(self):
 
         ret = 0
         logname = None
-        self._uninstall()
-        if self.install_yes:
+
+        ## incremental install replaces files which changed only
+        incremental = (os.environ.get('_BOS_INCREMENTAL_')
+                       and self._contents and self.install_yes
+                       and not self._cached)
+        if not incremental: self._uninstall()
+
+        if self._cached:
+            Blog.info("restoring %s from package cache" % self.name)
+            ret = self._cache_restore()
+            self._cached = None
+
+        elif self.install_yes:
             Blog.info("installing %s" % self.name)
-            if not os.path.exists(self._get_stagingdir()): os.makedirs(self._get_stagingdir())
+            ## staging area may be kept from previous install
+            if os.path.exists(self._get_stagingdir()): shutil.rmtree(self._get_stagingdir())
+            os.makedirs(self._get_stagingdir())
             ret,logname = bos_run(['make', '-C', os.path.join(Bos.topdir, self._src),
                                    '-f', os.path.join(Bos.mkdir, os.path.basename(self.mk)),
                                    '--no-print-directory',
                                    'DESTDIR=%s' % self._get_stagingdir(),
                                    'install'], self._get_logdir() + '-install')
-            if 0 == ret: ret = self._install()
-            shutil.rmtree(self._get_stagingdir())
+            if 0 == ret: ret = self._install(incremental)
+            if os.environ.get('_BOS_KEEP_STAGING_') != 'yes':
+                shutil.rmtree(self._get_stagingdir())
+            if 0 == ret: self._cache_store()
+
+            ## failed install leaves package uninstalled, incremental or not
+            elif incremental: self._uninstall()
 
         if 0 == ret:
             ## record package version
             self._version = self._get_version()
+
+            ## dependents are rebuilt only if installed contents changed
+            signature = _signature(self._contents)
+            self.changed = signature is None or signature != self._signature
+            self._signature = signature
+            if not self.changed:
+                Blog.info('%s installed contents unchanged' % self.name)
             self._flush()
         return (ret, logname)
 
@@ -203,13 +340,13 @@ class BosPackage(object):
 
         if self.clean_yes:
             Blog.info("cleaning %s" % self.name)
-            Bos.get_env(self._native)
             ret,logname = bos_run(['make', '-C', os.path.join(Bos.topdir, self._src),
                                    '-f', os.path.join(Bos.mkdir, os.path.basename(self.mk)),
                                    '--no-print-directory',
-                                   'clean'])
+                                   'clean'], env = Bos.get_env(self._native))
             if 0 != ret: Blog.warn('%s unable to clean' % self.name)
             self._revert_patch()
+            self._cached = None
 
             if self._gitdir:
                 with BosLockFile(os.path.join(Bos.topdir, self._gitdir, '.bos.lock')) as lock:
@@ -218,8 +355,9 @@ class BosPackage(object):
 
             self._uninstall()
 
+            ## .c is kept: touched again only if reinstalled contents change
             try:
-                for fn in glob.glob('%s.?' % (Bos.statesdir + self.name)): os.unlink(fn)
+                for fn in glob.glob('%s.[vpfbd]' % (Bos.statesdir + self.name)): os.unlink(fn)
                 Bos.touch(Bos.statesdir + self.name + '.v')
             except OSError as e:
                 Blog.warn(e.strerror + ': ' + e.filename)
@@ -234,13 +372,13 @@ class BosPackage(object):
 
         if self.clean_yes:
             Blog.info("purging %s" % self.name)
-            Bos.get_env(self._native)
             ret,logname = bos_run(['make', '-C', os.path.join(Bos.topdir, self._src),
                                    '-f', os.path.join(Bos.mkdir, os.path.basename(self.mk)),
                                    '--no-print-directory',
-                                   'clean'])
+                                   'clean'], env = Bos.get_env(self._native))
             if 0 != ret: Blog.warn('%s unable to clean' % self.name)
             self._revert_patch()
+            self._cached = None
 
             if self._gitdir:
                 with BosLockFile(os.path.join(Bos.topdir, self._gitdir, '.bos.lock')) as lock:
@@ -256,8 +394,9 @@ class BosPackage(object):
 
             self._purge()
 
+            ## .c is kept: touched again only if reinstalled contents change
             try:
-                for fn in glob.glob('%s.?' % (Bos.statesdir + self.name)): os.unlink(fn)
+                for fn in glob.glob('%s.[vpfbd]' % (Bos.statesdir + self.name)): os.unlink(fn)
                 Bos.touch(Bos.statesdir + self.name + '.v')
             except OSError as e:
                 Blog.warn(e.strerror + ': ' + e.filename)
@@ -268,24 +407,19 @@ class BosPackage(object):
 
         return (0, None)
 
-    def dump(self):
-
-        print '-' * 80
-        print '%-12s: %s' % ('NAME', self.name)
-        print '%-12s: %s' % ('DESCRIPTION', '\n\t'.join(self._description.split('\n')))
-        print '-' * 80
-        print '%-12s: %s' % ('MK', os.path.join(Bos.topdir, self.mk))
-        print '%-12s: %s' % ('SRC', os.path.join(Bos.topdir, self._src))
-        if self.require: print '%-12s: %s' % ('DEPEND', ' '.join(self.require))
-        print '-' * 80
-
-        if self._contents:
-            for k, v in self._contents.items():
-                print '\n%s:' % k
-                for i in v:
-                    print '\t%s %s %10s %s' % (i[0], i[1], i[2], i[3])
+    def info(self):
+        """return package info, with installed contents, as a dict."""
 
-        print
+        return {'name': self.name,
+                'description': self._description,
+                'mk': os.path.join(Bos.topdir, self.mk),
+                'src': os.path.join(Bos.topdir, self._src) if self._src else None,
+                'require': list(self.require),
+                'version': self._version,
+                'contents': dict((pn, [{'mode': c[0], 'owner': c[1],
+                                        'size': c[2], 'path': c[3]}
+                                       for c in ctnt])
+                                 for pn, ctnt in self._contents.items())}
 
     def _put_info(self, info):
 
@@ -293,11 +427,9 @@ class BosPackage(object):
 
     def _flush(self):
 
-        db = shelve.open(_get_shelf_name(self.name))
-        db['obj'] = self
-        db.close()
+        BosMetaDB.save(self)
 
-    def _install(self):
+    def _install(self, incremental = False):
         """
         install package from staging area to output area and populate DB
 
@@ -305,60 +437,174 @@ class BosPackage(object):
         - all package specified contents must exist, unless optional
         - all installed contents must associate with given package
 
+        the complete staging manifest is computed and checked against the
+        index DB first, then all files are moved under a single acquisition
+        of the global lock: either all of them are installed or none.
+
+        incremental install compares staging manifest with installed contents,
+        by size, mode and mtime, or content digest if _BOS_INCREMENTAL_ is
+        'hash'. identical files are left untouched, and files no longer in
+        package are removed.
+
         return: 0 if successful, error code otherwise
         """
 
+        stagingdir = self._get_stagingdir()
+
         ## walk through package and sub-package definitions if any
-        for kn in self._files:
-            if kn == 'files':
-                pn = self._basename
-            else:
-                pn = self._basename + kn[5:]
+        ctxs = []
+        claimed = set()
+        try:
+            manifest = BosStagingManifest(stagingdir)
+            for kn in self._files:
+                if kn == 'files':
+                    pn = self._basename
+                else:
+                    pn = self._basename + kn[5:]
 
-                Blog.debug('processing package: %s' % pn)
+                    Blog.debug('processing package: %s' % pn)
 
-            ctx = BosInstallContext(pn, self)
-            try:
+                ctx = BosInstallContext(pn, self)
                 for itm in self._files[kn].split('\n'):
                     if '' == itm.strip(): continue
 
                     ownership, pattern, optional = _parse_install_item(itm)
 
                     Blog.debug('processing pattern: %s' % pattern)
-                    flist = glob.glob(os.path.join(self._get_stagingdir(), pattern[1:]))
+                    flist = manifest.match(pattern)
                     if (not flist) and (not optional):
                         Blog.fatal('<%s> unable to find: %s' % (self.name,  pattern))
-                    for ff in flist: _install_files(ff, ownership, ctx)
-
-                for ctnt in ctx.contents:
-                    ff = ctnt[3]
-                    path = os.path.join(ctx.indexdir, ff[1:])
-                    if not os.path.exists(os.path.dirname(path)):
-                        os.makedirs(os.path.dirname(path))
-                    #with open(path, 'w') as f: f.write(ctx.name)
-                    os.symlink(ctx.name, path)
-            except:
-                Blog.error("%s unable to install." % self.name)
-                self._put_info({ctx.name:ctx.contents})
-                self._uninstall()
-                return -1
-
-            Blog.debug('%s writing package info' % ctx.name)
-            self._put_info({ctx.name:ctx.contents})
+                    for ff in flist:
+                        _collect_files(manifest, ff, ownership, ctx, claimed)
+                ctxs.append(ctx)
+
+            ## make sure there's no files left unpackaged
+            left = [fn for fn in manifest.sorted if fn not in claimed]
+            if left:
+                Blog.fatal('installed but unpackaged contents found: %s\n%s'
+                           % (self.name, '\n'.join(sorted(left))))
+
+            ## content digest of every file, in parallel for large packages
+            digests = _digests([ff for ctx in ctxs for ff in ctx.files])
+            for ctx in ctxs:
+                for ctnt in ctx.contents: ctnt.append(digests[ctnt[3][1:]])
+
+            owned = set()
+            removed = []
+            if incremental: owned, removed = self._install_diff(ctxs)
+        except:
+            Blog.error("%s unable to install." % self.name)
+            return -1
 
-        ## post process: walk the stagingdir to make sure there's no files left
+        ## actual install must acquire the global lock
+        lockdir = Bos.nativedirlock if self._native else Bos.targetdirlock
         try:
-            for r, d, f in os.walk(self._get_stagingdir()):
-                if f: Blog.fatal('installed but unpackaged contents found: %s\n%s'
-                                 % (self.name, _list_dir(self._get_stagingdir())))
+            with BosLockFile(lockdir) as lock:
+                _install_commit(ctxs, self._native, owned)
+                self._remove_files(removed)
         except:
-            Blog.error('%s unable to walk staging dir: %s'
-                       % (self.name, self._get_stagingdir()))
-            self._uninstall()
+            Blog.error("%s unable to install." % self.name)
             return -2
 
+        self._contents = {}
+        for ctx in ctxs:
+            Blog.debug('%s writing package info' % ctx.name)
+            self._put_info({ctx.name:ctx.contents})
+
         return 0
 
+    def verify(self):
+        """
+        verify installed files against package contents, by type, mode,
+        size and content digest.
+
+        return: list of (path, problem), empty if all files are intact
+        """
+
+        destdir = Bos.nativedir if self._native else Bos.targetdir
+        lockdir = Bos.nativedirlock if self._native else Bos.targetdirlock
+
+        problems = []
+        with BosLockFile(lockdir, shared = True) as lock:
+            files = []
+            for pn in sorted(self._contents):
+                for ctnt in self._contents[pn]:
+                    path = os.path.join(destdir, ctnt[3][1:])
+                    if not os.path.lexists(path):
+                        problems.append((ctnt[3], 'missing'))
+                        continue
+
+                    owner = _who_has(ctnt[3][1:], self._native)
+                    mode, size = bos_fileinfo(None, os.lstat(path))
+                    if owner != pn:
+                        problems.append((ctnt[3], 'owned by %s' % owner))
+                    elif mode != ctnt[0]:
+                        problems.append((ctnt[3], 'mode %s, expected %s'
+                                         % (mode, ctnt[0])))
+                    elif size != ctnt[2]:
+                        problems.append((ctnt[3], 'size %s, expected %s'
+                                         % (size, ctnt[2])))
+                    elif len(ctnt) > 5:
+                        files.append((path, ctnt[3][1:]))
+                    else:
+                        Blog.debug('%s has no digest: %s' % (self.name, ctnt[3]))
+
+            digests = _digests(files)
+            for pn in sorted(self._contents):
+                for ctnt in self._contents[pn]:
+                    if ctnt[3][1:] in digests and digests[ctnt[3][1:]] != ctnt[5]:
+                        problems.append((ctnt[3], 'content changed'))
+
+        return problems
+
+    def _install_diff(self, ctxs):
+        """
+        drop files identical to installed ones from contexts to install.
+
+        return a tuple of (installed paths, [(package, contents entry)] of
+        files no longer in package)
+        """
+
+        destdir = Bos.nativedir if self._native else Bos.targetdir
+        digest = os.environ.get('_BOS_INCREMENTAL_') == 'hash'
+
+        installed = {}
+        for pn in self._contents:
+            for ctnt in self._contents[pn]: installed[ctnt[3][1:]] = (pn, ctnt)
+
+        unchanged = 0
+        for ctx in ctxs:
+            files = []
+            for (src, rel_src), ctnt in zip(ctx.files, ctx.contents):
+                old = installed.pop(rel_src, (None, None))[1]
+                if (old and old[:3] == ctnt[:3] and len(old) >= len(ctnt)
+                    and old[5 if digest else 4] == ctnt[5 if digest else 4]
+                    and os.path.lexists(os.path.join(destdir, rel_src))):
+                    unchanged += 1
+                else:
+                    files.append((src, rel_src))
+            ctx.files = files
+
+        Blog.debug('%s incremental install: %d unchanged, %d removed'
+                   % (self.name, unchanged, len(installed)))
+
+        owned = set()
+        for pn in self._contents:
+            for ctnt in self._contents[pn]: owned.add(ctnt[3][1:])
+        return (owned, installed.values())
+
+    def _remove_files(self, removed):
+        """remove given installed files of package, caller holds the global lock."""
+
+        destdir = Bos.nativedir if self._native else Bos.targetdir
+        for pn, ctnt in removed:
+            Blog.debug('%s removing %s' % (self.name, ctnt[3][1:]))
+            try: os.unlink(os.path.join(destdir, ctnt[3][1:]))
+            except OSError as e:
+                if e.errno != errno.ENOENT: raise
+            _remove_index(pn, [ctnt], self._native)
+            bos_rm_empty_path(os.path.dirname(ctnt[3]), destdir)
+
     def _uninstall(self):
         """
         uninstall package both from output and index DB area
@@ -376,12 +622,14 @@ class BosPackage(object):
                     for lst in self._contents[pn]:
                         fn = lst[3]
                         Blog.debug('%s removing %s' % (self.name, fn[1:]))
-                        if self._native:
-                            os.unlink(os.path.join(Bos.nativedir, fn[1:]))
-                            os.unlink(os.path.join(Bos.nativeindexdir, fn[1:]))
-                        else:
-                            os.unlink(os.path.join(Bos.targetdir, fn[1:]))
-                            os.unlink(os.path.join(Bos.targetindexdir, fn[1:]))
+                        try:
+                            if self._native:
+                                os.unlink(os.path.join(Bos.nativedir, fn[1:]))
+                            else:
+                                os.unlink(os.path.join(Bos.targetdir, fn[1:]))
+                        except OSError as e:
+                            if e.errno != errno.ENOENT: raise
+                    BosMetaDB.remove_owner(pn, native = self._native)
 
                 ## check output area to remove left-over empty paths
                 for kn in self._files:
@@ -392,10 +640,8 @@ class BosPackage(object):
                         if dn and  '/' != dn:
                             if self._native:
                                 bos_rm_empty_path(dn, Bos.nativedir)
-                                bos_rm_empty_path(dn, Bos.nativeindexdir)
                             else:
                                 bos_rm_empty_path(dn, Bos.targetdir)
-                                bos_rm_empty_path(dn, Bos.targetindexdir)
 
         except: ## all uninstall errors are ignored
             Blog.debug('%s unable to uninstall.' % self.name)
@@ -411,11 +657,82 @@ class BosPackage(object):
 
         self._uninstall()
 
-        for r,d,f in os.walk(
-            Bos.nativeindexdir if self._native else Bos.targetindexdir):
-            for fn in f:
-                if (self.name == os.readlink(os.path.join(r, fn))):
-                    os.unlink(os.path.join(r, fn))
+        ## dangling index entries of package and its sub-packages
+        for kn in self._files:
+            pn = self._basename + ('' if kn == 'files' else kn[5:])
+            BosMetaDB.remove_owner(BosInstallContext(pn, self).name,
+                                   native = self._native)
+
+    def _cache_lookup(self):
+        """
+        look up package in binary package cache, if enabled.
+
+        return True if package is to be restored from cache at install
+        """
+
+        self._cached = None
+        self._cachekey = None
+        cache = BosPkgCache.get()
+        if cache:
+            key = self._cachekey = cache.key(self)
+            if key and cache.load(key): self._cached = key
+
+        self._flush()
+        return bool(self._cached)
+
+    def _cache_store(self):
+        """
+        store installed package into binary package cache, if enabled.
+        """
+
+        cache = BosPkgCache.get()
+        if not cache or not self._contents: return
+
+        key = self._cachekey or cache.key(self)
+        if not key: return
+        try:
+            if cache.store(key, self._contents,
+                           Bos.nativedir if self._native else Bos.targetdir):
+                Blog.debug('%s stored in package cache: %s' % (self.name, key))
+        except (IOError, OSError) as e:
+            Blog.warn('%s unable to store in package cache: %s' % (self.name, e))
+
+    def _cache_restore(self):
+        """
+        restore package from binary package cache to output area and index DB.
+
+        return: 0 if successful, error code otherwise
+        """
+
+        cache = BosPkgCache.get()
+        manifest = cache.load(self._cached) if cache else None
+        if not manifest:
+            Blog.error('%s missing from package cache: %s' % (self.name, self._cached))
+            return -1
+
+        destdir = Bos.nativedir if self._native else Bos.targetdir
+        lockdir = Bos.nativedirlock if self._native else Bos.targetdirlock
+        try:
+            with BosLockFile(lockdir) as lock:
+                for pn, contents in manifest['contents'].items():
+                    for ctnt in contents:
+                        dest = os.path.join(destdir, ctnt[3][1:])
+                        if os.path.lexists(dest):
+                            owner = _who_has(ctnt[3][1:], self._native)
+                            if owner != pn:
+                                Blog.fatal('package %s conflicts with: %s\n%s'
+                                           % (pn, owner, ctnt[3]))
+                            os.unlink(dest)
+                        cache.restore(manifest['files'][ctnt[3]], dest)
+
+                    self._put_info({pn: contents})
+                    _add_index(pn, contents, self._native)
+        except:
+            Blog.error("%s unable to restore from package cache." % self.name)
+            self._uninstall()
+            return -1
+
+        return 0
 
     def _apply_patch(self):
         """
@@ -455,76 +772,13 @@ class BosPackage(object):
     def _get_mk(self):
         Blog.debug("get mkpath for: %s" % self.name)
 
-        mkpath = self._do_get_mk(Bos.distrodir)
-        if not mkpath: mkpath = self._do_get_mk(Bos.topdir)
+        mkpath = BosMkIndex.find(self.name)
 
         Blog.debug("mk for: %s as: %s" % (self.name, mkpath))
-        if mkpath: return(mkpath[len(Bos.topdir):])
         return mkpath
 
-    def _do_get_mk(self, root):
-        Blog.debug('search mk at: %s for %s' % (root, self.name))
-
-        mk = None
-        path = None
-        for r,d,f in os.walk(os.path.join(root, 'bm')):
-            for fn in f:
-                if fn.endswith('.mk'):
-                    Blog.debug('mk found as: %s at %s' % (fn, r))
-                    if fn == '%s.mk' % self.name:
-                        return os.path.join(r, fn)
-                    if True == self._native:
-                        if fn == '%s.mk' % self._basename:
-                            mk = fn
-                            path = r
-
-        return None if not mk else os.path.join(path, mk)
-
-    def _preprocess_mk(self):
-        import re
-        mk_full_path = os.path.join(Bos.topdir, self.mk)
-        meta = mk_full_path + '.meta'
-        real = os.path.join(Bos.mkdir, os.path.basename(self.mk))
-
-        self.prepare_yes = False
-        self.config_yes = False
-        self.compile_yes = False
-        self.install_yes = False
-        self.clean_yes = False
-
-        r = open(real, "w")
-        try:
-            r.write('## AUTOGENERATED FILE - DO NOT MODIFY\n')
-            r.write('.PHONY: prepare config compile install clean\n')
-
-            with open(meta, "w") as m:
-                m.write('[BOSMK]\n')
-                for line in open(mk_full_path):
-                    if line[:3] == '## ': m.write(line[3:])
-                    else:
-                        if re.match(r'^\s*$', line): continue
-                        else : r.write(line)
-
-                        if re.match(r'^\w+', line) :
-                            if re.match(r'.*\bprepare\b', line):
-                                self.prepare_yes = True
-                            if re.match(r'.*\bconfig\b', line):
-                                self.config_yes = True
-                            if re.match(r'.*\bcompile\b', line):
-                                self.compile_yes = True
-                            if re.match(r'.*\binstall\b', line):
-                                self.install_yes = True
-                            if re.match(r'.*\bclean\b', line):
-                                self.clean_yes = True
-
-        finally:
-            r.close()
-
-        return meta
-
-
     def _get_stagingdir(self):
-        return os.path.join(Bos.cachedir, self.name)
+        return os.path.join(Bos.stagingdir, self.name)
 
 
     def _get_logdir(self):
@@ -534,75 +788,218 @@ class BosPackage(object):
     def _get_gitdir(self):
         gitdir = None
         if self._src:
-            from subprocess import Popen, PIPE
-            out, err = Popen('cd %s; git rev-parse --show-toplevel'
-                             % os.path.join(Bos.topdir, self._src), shell = True,
-                             stdout = PIPE, stderr = PIPE
-                             ).communicate()
-            if err: Blog.warn('%s: not a git repository.' % os.path.join(Bos.topdir, self._src))
-            else: gitdir = os.path.join(out.strip(), '.git')[len(Bos.topdir):]
+            top = bos_git_toplevel(os.path.join(Bos.topdir, self._src))
+            if not top: Blog.warn('%s: not a git repository.' % os.path.join(Bos.topdir, self._src))
+            else: gitdir = os.path.join(top, '.git')[len(Bos.topdir):]
         return gitdir
 
     def _get_version(self):
 
-        version = 'unknown'
-        if self._gitdir:
-            from subprocess import Popen, PIPE
-            out,err = Popen('cd %s; git describe --all'
-                            % os.path.join(Bos.topdir, self._gitdir), shell = True,
-                            stdout = PIPE, stderr = PIPE).communicate()
-            if not err: version = out.strip()
+        return _fingerprint(self.mk, self._patch, self._gitdir, self._src)
+
+
+_re_target = re.compile(r'^\w+')
+_re_phase = re.compile(r'\b(prepare|config|compile|install|clean)\b')
+
+def _parse_mk(path):
+    """
+    parse package .mk in a single pass, in memory.
 
-        return version
+    lines starting with '## ' make up the package header, all other non-empty
+    lines the package makefile, whose targets tell which phases it supports.
 
+    return a tuple of (header, makefile, set of phases)
+    """
+
+    header = ['[BOSMK]\n']
+    makefile = ['## AUTOGENERATED FILE - DO NOT MODIFY\n',
+                '.PHONY: prepare config compile install clean\n']
+    phases = set()
+
+    for line in open(path):
+        if line[:3] == '## ': header.append(line[3:])
+        elif line.strip():
+            makefile.append(line)
+            if _re_target.match(line): phases.update(_re_phase.findall(line))
+
+    return (''.join(header), ''.join(makefile), phases)
 
 def _get_shelf_name(name):
     """return shelf path for package with given name."""
 
     return os.path.join(Bos.shelvedir, name)
 
-def _install_files(src, ownership, context):
+def _load_shelf(name):
+    """
+    move package put on shelf by older versions into metadata DB.
 
-    if os.path.isdir(src):
-        for ff in os.listdir(src):
-            Blog.debug('installing: %s' % ff)
-            _install_files(os.path.join(src, ff), ownership, context)
-    else:
-        rel_src = src[context.baselen:]
-        if rel_src[0] == '/': rel_src = rel_src[1:]
+    return package if found on shelf, None otherwise
+    """
 
-        mode, size = bos_fileinfo(src)
+    fn = _get_shelf_name(name)
+    files = [f for f in [fn, fn + '.db', fn + '.dat', fn + '.dir', fn + '.bak']
+             if os.path.exists(f)]
+    if not files: return None
 
-        ## actual install must acquire the global lock
-        lockdir = Bos.nativedirlock if context.pkg._native else Bos.targetdirlock
-        with BosLockFile(lockdir) as lock:
+    try:
+        db = shelve.open(fn, 'r')
+        pkg = db['obj']
+        db.close()
+        pkg._flush()
+    except:
+        pkg = None
 
-            path = os.path.join(context.destdir, os.path.dirname(rel_src))
-            if not os.path.exists(path): os.makedirs(path)
+    for f in files: os.unlink(f)
+    return pkg
 
-            Blog.debug('installing from: %s to %s' % (src, path))
-            try:
-                shutil.move(src, path + '/')
-            except shutil.Error:
-                owner = _who_has(rel_src, context.pkg._native)
-                if owner == context.name:
-                    os.unlink(path, os.path.basename(src))
-                    shutil.move(src, path + '/')
-                else:
-                    Blog.fatal('package %s conflicts with: %s\n%s'
-                               % (context.name, owner, rel_src))
+def _add_index(name, contents, native = False):
+    """add index DB entries for package contents owned by name."""
+
+    BosMetaDB.add_owner(name, [ctnt[3] for ctnt in contents], native)
+
+def _remove_index(name, contents, native = False):
+    """remove index DB entries for package contents owned by name, if any."""
+
+    BosMetaDB.remove_owner(name, [ctnt[3] for ctnt in contents], native)
+
+def _collect_files(manifest, path, ownership, context, claimed):
+    """
+    add staging file, or all files under staging directory, to package
+    contents unless claimed already by another pattern or sub-package.
+    """
+
+    stagingdir = context.pkg._get_stagingdir()
+    for rel_src in manifest.expand(path):
+        if rel_src in claimed: continue
+        claimed.add(rel_src)
+
+        mode, size = bos_fileinfo(None, manifest.files[rel_src])
 
         info = []
-        ## if file is no longer in src, it must be in destdir already
-        if '----------' == mode:
-            mode, size = bos_fileinfo(os.path.join(context.destdir, rel_src))
         info.append(mode)
         info.append(ownership if ownership else 'root:root')
         info.append(size)
         info.append('/' + rel_src)
+        info.append(manifest.files[rel_src].st_mtime)
 
+        context.files.append((os.path.join(stagingdir, rel_src), rel_src))
         context.contents.append(info)
 
+def _install_commit(contexts, native, owned = set()):
+    """
+    move collected files of all contexts to output area, and add them to
+    index DB. caller must hold the global lock.
+
+    any conflict with contents of other packages, but paths 'owned' by the
+    package installed already, is detected before the first file is moved.
+    on error all moved files are moved back to staging area.
+
+    files are renamed into place, or linked if staging area is to be kept.
+    """
+
+    conflicts = []
+    for ctx in contexts:
+        for src, rel_src in ctx.files:
+            if os.path.lexists(os.path.join(ctx.destdir, rel_src)):
+                owner = _who_has(rel_src, native)
+                if owner != ctx.name and rel_src not in owned:
+                    conflicts.append('%s: %s' % (owner, rel_src))
+    if conflicts:
+        Blog.fatal('package %s conflicts with:\n%s'
+                   % (contexts[0].pkg.name, '\n'.join(conflicts)))
+
+    keep = os.environ.get('_BOS_KEEP_STAGING_') == 'yes'
+    done = []
+    dirs = set()
+    copied = 0
+    try:
+        for ctx in contexts:
+            for src, rel_src in ctx.files:
+                path = os.path.join(ctx.destdir, rel_src)
+                dn = os.path.dirname(path)
+                if dn not in dirs:
+                    if not os.path.isdir(dn): os.makedirs(dn)
+                    dirs.add(dn)
+
+                Blog.debug('installing from: %s to %s' % (src, path))
+                ## left-over of the same package, replace it
+                if os.path.lexists(path): os.unlink(path)
+                how = bos_install_file(src, path, keep)
+                if how == 'copy': copied += 1
+                done.append((src, path, keep))
+
+            _add_index(ctx.name, ctx.contents, native)
+    except:
+        Blog.error('%s rolling back install' % contexts[0].pkg.name)
+        for src, path, kept in reversed(done):
+            try:
+                if kept: os.unlink(path)
+                else: shutil.move(path, src)
+            except: Blog.warn('unable to roll back: %s' % path)
+        for ctx in contexts: _remove_index(ctx.name, ctx.contents, native)
+        raise
+
+    if copied:
+        Blog.warn('%s: %d files copied, staging and output area are not on '
+                  'the same filesystem' % (contexts[0].pkg.name, copied))
+
+def _signature(contents):
+    """
+    return digest of package contents as seen by dependents: paths, modes
+    and file digests. None if any file has no digest.
+    """
+
+    h = hashlib.sha1()
+    for path, ctnt in sorted((c[3], c) for pn in contents for c in contents[pn]):
+        if len(ctnt) < 6: return None
+        h.update('%s\0%s\0%s\0' % (path, ctnt[0], ctnt[5]))
+    return h.hexdigest()
+
+def _fingerprint(mk, patches, gitdir, src):
+    """
+    return version of package as fingerprint of all its inputs: contents of
+    .mk and patch files, and tracked files of source tree.
+    """
+
+    h = hashlib.sha1()
+    h.update(bos_git_fingerprint(gitdir, src))
+
+    mkdir = os.path.dirname(os.path.join(Bos.topdir, mk))
+    for fn in [os.path.basename(mk)] + patches:
+        h.update('\0%s\0' % fn)
+        h.update(_digest(os.path.join(mkdir, fn)))
+    return h.hexdigest()
+
+def _digest(path):
+    """return binary sha1 digest of file contents, or link target if symlink."""
+
+    h = hashlib.sha1()
+    if os.path.islink(path):
+        h.update(os.readlink(path))
+    elif os.path.isfile(path):
+        with open(path, 'rb') as f:
+            while True:
+                buf = f.read(1 << 20)
+                if not buf: break
+                h.update(buf)
+    return h.digest()
+
+def _digests(files, jobs = 4):
+    """
+    return {relative path: digest} of given [(path, relative path)] files,
+    hashed by 'jobs' threads in parallel if there are many of them.
+    """
+
+    paths = [f[0] for f in files]
+    if len(paths) > 64:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(jobs)
+        try: digests = pool.map(_digest, paths, 16)
+        finally: pool.close()
+    else:
+        digests = [_digest(p) for p in paths]
+
+    return dict(zip([f[1] for f in files], digests))
 
 def _parse_install_item(item):
 
@@ -630,24 +1027,6 @@ def _parse_install_item(item):
     return (ownership, pattern, optional)
 
 
-def _list_dir(dirname):
-
-    dirlen = len(dirname)
-    files = []
-    for r, d, f in os.walk(dirname):
-        for fn in f:
-            base_r = r[dirlen:]
-            files.append(os.path.join(base_r if base_r else '/', fn))
-    return '\n'.join(files)
-
-
 def _who_has(content, native = False):
 
-    path = os.path.join(Bos.nativeindexdir if native else Bos.targetindexdir, content)
-    try:
-        #owner = open(path).read()
-        owner = os.readlink(path)
-    except:
-        owner = None
-
-    return owner
+    return BosMetaDB.owner(content, native)
@@ -0,0 +1,177 @@
+# Copyright (C) 2012        SWOAG Technology
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import os, sys, stat, hashlib, tempfile, threading
+import cPickle as pickle
+
+from bomb.main import Bos
+from bomb.log import Blog
+from bomb.util import bos_clone
+from bomb.gitrepo import bos_git_fingerprint
+
+class BosPkgCache(object):
+    """
+    local content-addressed binary package cache
+
+    a package is cached under a key hashed from everything its installed
+    contents derive from: .mk file, patches, source revision, build env and
+    the keys of all required packages. the cache is laid out as:
+
+        objects/xx/xxxx...  file data, named by sha1 of its contents
+        keys/<key>          pickled manifest of the installed package
+
+    the cache is enabled by bosm --pkgcache, which exports its location to
+    all build processes as _BOS_PKGCACHE_.
+    """
+
+    _keys = {}
+
+    def __init__(self, path):
+
+        self.path = path
+        self.objdir = os.path.join(path, 'objects')
+        self.keydir = os.path.join(path, 'keys')
+
+        for d in [self.objdir, self.keydir]:
+            if not os.path.exists(d):
+                try: os.makedirs(d)
+                except OSError: pass ## created by concurrent build
+
+    @classmethod
+    def get(cls):
+        """return package cache if enabled, None otherwise."""
+
+        path = os.environ.get('_BOS_PKGCACHE_')
+        return BosPkgCache(path) if path else None
+
+    def key(self, pkg):
+        """
+        return cache key of given package, None if it can not be cached,
+        i.e. package, or any of its dependencies, has no source revision.
+        """
+
+        if pkg.name in BosPkgCache._keys: return BosPkgCache._keys[pkg.name]
+
+        from bomb.package import BosPackage
+
+        key = None
+        ## source tree as is, uncommitted changes included, taken at lookup
+        ## before patches are applied, and kept by package for store
+        version = bos_git_fingerprint(pkg._gitdir, pkg._src)
+        if version != 'unknown':
+            h = hashlib.sha1()
+            h.update('%s\0%s\0' % (pkg.name, version))
+
+            mkdir = os.path.dirname(os.path.join(Bos.topdir, pkg.mk))
+            for fn in [os.path.basename(pkg.mk)] + pkg._patch:
+                with open(os.path.join(mkdir, fn), 'rb') as f: h.update(f.read())
+
+            for k, v in sorted(Bos.load_env(pkg._native).items()):
+                h.update('%s=%s\0' % (k, v))
+
+            for dep in pkg.require:
+                dep = BosPackage.open(dep)
+                dep_key = dep._cachekey or self.key(dep)
+                if not dep_key: break
+                h.update(dep_key)
+            else:
+                key = h.hexdigest()
+
+        Blog.debug('%s cache key: %s' % (pkg.name, key))
+        BosPkgCache._keys[pkg.name] = key
+        return key
+
+    def load(self, key):
+        """return manifest stored under key, None on cache miss."""
+
+        try:
+            with open(os.path.join(self.keydir, key), 'rb') as f:
+                return pickle.load(f)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def store(self, key, contents, destdir):
+        """
+        store installed package under key.
+
+        contents: package contents, {package-name: [[mode owner size path]]}
+        destdir: output area contents are installed into
+
+        return True if successful, False if contents can not be cached
+        """
+
+        files = {}
+        for pn in contents:
+            for ctnt in contents[pn]:
+                src = os.path.join(destdir, ctnt[3][1:])
+                st = os.lstat(src)
+                if stat.S_ISLNK(st.st_mode):
+                    files[ctnt[3]] = ('l', os.readlink(src))
+                elif stat.S_ISREG(st.st_mode):
+                    files[ctnt[3]] = ('f', self._put_object(src),
+                                      stat.S_IMODE(st.st_mode))
+                else:
+                    Blog.debug('unable to cache special file: %s' % src)
+                    return False
+
+        manifest = {'contents': contents, 'files': files}
+        fd, tmp = tempfile.mkstemp(dir = self.keydir)
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(manifest, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, os.path.join(self.keydir, key))
+        return True
+
+    def restore(self, entry, dest):
+        """restore one manifest file entry to dest."""
+
+        dn = os.path.dirname(dest)
+        if not os.path.exists(dn): os.makedirs(dn)
+
+        if entry[0] == 'l':
+            os.symlink(entry[1], dest)
+        else:
+            tmp = dest + '.bos-tmp'
+            if os.path.lexists(tmp): os.unlink(tmp)
+            bos_clone(self._get_object(entry[1]), tmp)
+            os.chmod(tmp, entry[2])
+            os.rename(tmp, dest)
+
+    def _get_object(self, digest):
+
+        return os.path.join(self.objdir, digest[:2], digest[2:])
+
+    def _put_object(self, src):
+        """
+        add file into object store unless stored already, data is shared
+        with src where reflinks are supported. return its content digest.
+        """
+
+        h = hashlib.sha1()
+        with open(src, 'rb') as f:
+            while True:
+                buf = f.read(1 << 20)
+                if not buf: break
+                h.update(buf)
+
+        digest = h.hexdigest()
+        obj = self._get_object(digest)
+        if not os.path.exists(obj):
+            if not os.path.exists(os.path.dirname(obj)):
+                try: os.makedirs(os.path.dirname(obj))
+                except OSError: pass
+            tmp = '%s.%d.%d.tmp' % (obj, os.getpid(), threading.current_thread().ident)
+            bos_clone(src, tmp)
+            os.rename(tmp, obj)
+        return digest
@@ -0,0 +1,247 @@
+# Copyright (C) 2012        SWOAG Technology
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import os, sys, threading, heapq
+from Queue import Queue, Empty
+
+from bomb.main import Bos
+from bomb.log import Blog
+from bomb.depgraph import BosDepGraph
+from bomb.stats import BosStats
+from bomb.jobserver import BosJobServer
+from bomb.membudget import BosMemBudget
+
+class BosScheduler(object):
+    """
+    in-process build scheduler, an alternative to mk/main.mk
+
+    the dependency graph is loaded from bootstrap output once, packages are
+    kept in memory and their phases run on a pool of worker threads. phase
+    completion is recorded in the same .p/.f/.b/.d state files, and a phase
+    is considered out of date exactly when main.mk would consider it so.
+
+    ready packages are started in order of their critical path, as learned
+    from previous builds, or in configured order. each running package holds
+    a job slot of the jobserver shared with all package makes, and packages
+    are only started while their expected peak RSS fits the memory budget.
+
+    typical usage:  ret = BosScheduler(jobs).build(['all'])
+    """
+
+    ## (phase, state suffix), in build order
+    phases = [('prepare', '.p'), ('config', '.f'),
+              ('compile', '.b'), ('install', '.d')]
+
+    def __init__(self, jobs = None, order = 'critical'):
+
+        ## jobserver of bosm, or a private one if there is none
+        self.jobserver = BosJobServer.get()
+        if not self.jobserver:
+            self.jobserver = BosJobServer.create(jobs or BosJobServer.default_jobs())
+            self.jobserver.export()
+
+        self.graph = BosDepGraph.load()
+        self.packages = self.graph.names()
+        self.require = self.graph.require
+        self.pkgs = {}
+        self.seq = dict((pn, i) for i, pn in enumerate(self.packages))
+        self.peaks = {}
+
+        if order == 'critical':
+            self.priority = self.graph.critical_path(BosStats.durations())
+        else:
+            self.priority = dict((pn, -i) for pn, i in self.seq.items())
+
+    def can_build(self, target):
+        """return True if target can be built without main.mk."""
+
+        return target == 'all' or target in self.packages
+
+    def build(self, targets):
+        """
+        build given targets: 'all' brings every package up to date, a package
+        name does so for its dependencies and then rebuilds it from clean.
+
+        return: 0 if successful, error code otherwise
+        """
+
+        force = set()
+        names = []
+        for t in targets:
+            if t == 'all': names.extend(self.packages)
+            else:
+                names.append(t)
+                force.add(t)
+
+        ## all packages reachable from targets, with pending dependencies
+        pending = {}
+        while names:
+            name = names.pop()
+            if name in pending: continue
+            pending[name] = set(self.require.get(name, []))
+            names.extend(pending[name])
+
+        rdeps = {}
+        for name in pending:
+            for dep in pending[name]: rdeps.setdefault(dep, []).append(name)
+
+        ready = []
+        for n in pending:
+            if not pending[n]: self._push(ready, n)
+        done = Queue()
+        failed = []
+        running = {} #{name: job token, None for the implicit job slot}
+
+        Blog.debug('scheduling %d packages on %d jobs'
+                   % (len(pending), self.jobserver.jobs))
+        while ready or running:
+            while ready and not failed:
+                name = self._admit(ready, running)
+                if not name: break
+
+                token = None
+                if None in running.values():
+                    token = self.jobserver.acquire()
+                    if not token:
+                        self._push(ready, name)
+                        break
+                t = threading.Thread(target = self._build_pkg,
+                                     args = (name, name in force, done))
+                t.daemon = True
+                t.start()
+                running[name] = token
+
+            if not running: break
+
+            ## poll with timeout, so that the main thread remains interruptible,
+            ## and job slots given back by others are taken up soon
+            try: name, ok = done.get(True, .1 if ready else 1)
+            except Empty: continue
+
+            token = running.pop(name)
+            if token: self.jobserver.release(token)
+            if not ok:
+                failed.append(name)
+                continue
+
+            for r in rdeps.get(name, []):
+                pending[r].discard(name)
+                if not pending[r]: self._push(ready, r)
+
+        if failed:
+            Blog.error('build failed: %s' % ' '.join(failed))
+            return -1
+        return 0
+
+    def _admit(self, ready, running):
+        """
+        pop ready package of highest priority whose expected peak RSS fits
+        into memory budget along with running packages, None if none fits.
+        """
+
+        peaks = [self._peak(n) for n in running]
+        skipped = []
+        name = None
+        while ready:
+            n = heapq.heappop(ready)
+            if BosMemBudget.fits(peaks, self._peak(n[-1])):
+                name = n[-1]
+                break
+            skipped.append(n)
+
+        for n in skipped: heapq.heappush(ready, n)
+        if skipped and not name:
+            Blog.debug('scheduler: memory budget exceeded, queueing %s'
+                       % ' '.join([n[-1] for n in skipped]))
+        return name
+
+    def _peak(self, name):
+
+        if name not in self.peaks: self.peaks[name] = BosStats.peak(name)
+        return self.peaks[name]
+
+    def _push(self, ready, name):
+
+        ## highest priority first, and in configured order among equals
+        heapq.heappush(ready, (-self.priority.get(name, 0),
+                               self.seq[name], name))
+
+    def _build_pkg(self, name, force, done):
+
+        from bomb.package import BosPackage
+
+        try:
+            pkg = self.pkgs.get(name)
+            if not pkg:
+                pkg = BosPackage.open(name)
+                self.pkgs[name] = pkg
+
+            if force:
+                Blog.debug('scheduler: rebuilding %s' % name)
+                pkg.clean()
+
+            stale = force
+            for phase, suffix in self.phases:
+                state = _state(name, suffix)
+                if not stale: stale = self._is_stale(name, suffix, state)
+                if not stale: continue
+
+                Blog.debug('scheduler: %s %s' % (phase, name))
+                ret, logname = getattr(pkg, phase)()
+                if 0 != ret:
+                    Blog.fatal('%s failed to %s, see log at: %s'
+                               % (name, phase, logname))
+                Bos.touch(state)
+
+                if suffix == '.d' and (pkg.changed
+                                       or not os.path.exists(_state(name, '.c'))):
+                    Bos.touch(_state(name, '.c'))
+
+            done.put((name, True))
+
+        except Exception as e:
+            Blog.debug('scheduler: %s failed: %s' % (name, e))
+            done.put((name, False))
+
+    def _is_stale(self, name, suffix, state):
+        """
+        return True if state is older than any of its prerequisites, as
+        declared for the same state in main.mk and deps.mk.
+        """
+
+        if not os.path.exists(state): return True
+
+        if suffix == '.p':
+            prereqs = [_state(name, '.v')]
+        elif suffix == '.f':
+            prereqs = [_state(name, '.p')]
+            for dep in self.require.get(name, []):
+                ## .c as old as .d if missing, as in main.mk
+                if os.path.exists(_state(dep, '.c')): prereqs.append(_state(dep, '.c'))
+                else: prereqs.append(_state(dep, '.d'))
+        elif suffix == '.b':
+            prereqs = [_state(name, '.f')]
+        else:
+            prereqs = [_state(name, '.b')]
+
+        mtime = os.path.getmtime(state)
+        for p in prereqs:
+            if os.path.exists(p) and os.path.getmtime(p) > mtime: return True
+        return False
+
+
+def _state(name, suffix):
+
+    return os.path.join(Bos.statesdir, name + suffix)
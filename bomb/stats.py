@@ -0,0 +1,224 @@
+# Copyright (C) 2012        SWOAG Technology
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import os, sys, time, json, atexit, threading
+from functools import wraps
+
+from bomb.main import Bos
+from bomb.log import Blog
+from bomb.metadb import BosMetaDB
+from bomb.membudget import BosMemBudget
+
+class BosStats(object):
+    """
+    build timing and resource usage statistics
+
+    every package phase records its wall time, together with user and system
+    CPU time and peak RSS of all commands it ran, as accounted by bos_run.
+    peak RSS of a command is that of its whole process tree, as sampled
+    while it runs, so that all jobs of a parallel make count.
+    records are kept in the metadata database for the last 'builds' builds,
+    a build being one bosm invocation.
+
+    a phase only starts once admitted by the memory budget, by the peak RSS
+    it reached before.
+
+    typical usage:  @BosStats.phase('compile')
+                    def compile(self): ...
+    """
+
+    builds = 20
+
+    _local = threading.local()
+
+    @classmethod
+    def phase(cls, phase):
+        """decorator recording stats of a package phase method."""
+
+        def decorator(func):
+            @wraps(func)
+            def wrapper(pkg, *args, **kwargs):
+                with BosMemBudget.admit(pkg.name, cls.peak(pkg.name, phase)):
+                    usage = [0.0, 0.0, 0]
+                    cls._local.usage = usage
+                    start = time.time()
+                    ret = (-1, None)
+                    try:
+                        ret = func(pkg, *args, **kwargs)
+                        return ret
+                    finally:
+                        cls._local.usage = None
+                        cls._save(pkg.name, phase, start, time.time() - start,
+                                  usage, ret[0])
+            return wrapper
+        return decorator
+
+    @classmethod
+    def recording(cls):
+        """return True if calling thread runs a phase being recorded."""
+
+        return getattr(cls._local, 'usage', None) is not None
+
+    @classmethod
+    def account(cls, ru, peak = 0):
+        """
+        account resource usage of a finished command to running phase,
+        with sampled peak RSS of its process tree in KB, if any.
+        """
+
+        usage = getattr(cls._local, 'usage', None)
+        if usage is None: return
+        usage[0] += ru.ru_utime
+        usage[1] += ru.ru_stime
+        usage[2] = max(usage[2], ru.ru_maxrss, peak)
+
+    @classmethod
+    def prune(cls):
+        """forget stats of all but the last builds."""
+
+        with BosMetaDB.transaction() as db:
+            for table in ['stats', 'lockstats']:
+                db.execute('DELETE FROM %s WHERE build NOT IN'
+                           ' (SELECT DISTINCT build FROM %s'
+                           '  ORDER BY build DESC LIMIT ?)' % (table, table),
+                           (cls.builds,))
+
+    @classmethod
+    def peak(cls, package, phase = None):
+        """
+        return peak RSS in KB, of given package phase, or of any phase if
+        not given, in its last builds. 0 if it was never built.
+        """
+
+        sql = 'SELECT maxrss FROM stats WHERE package = ? AND ret = 0'
+        args = (package,)
+        if phase:
+            sql += ' AND phase = ?'
+            args += (phase,)
+        rows = BosMetaDB.connect().execute(sql + ' ORDER BY id DESC LIMIT 12',
+                                           args).fetchall()
+        return max([r[0] for r in rows] or [0])
+
+    @classmethod
+    def durations(cls):
+        """return expected build time of every package, as of its latest build."""
+
+        return dict((pn, sum([r[0][0] for r in runs.values()]))
+                    for pn, runs in cls.summary().items())
+
+    @classmethod
+    def summary(cls):
+        """
+        return latest and previous stats of every package and phase as
+        {package: {phase: [(wall, utime, stime, maxrss)]}}, latest first.
+        """
+
+        summary = {}
+        for r in BosMetaDB.connect().execute(
+            'SELECT package, phase, wall, utime, stime, maxrss FROM stats'
+            ' WHERE ret = 0 ORDER BY id DESC'):
+            runs = summary.setdefault(r[0], {}).setdefault(r[1], [])
+            if len(runs) < 2: runs.append(r[2:])
+        return summary
+
+    @classmethod
+    def locks(cls):
+        """return lock stats of all builds as [(lockfile, count, contended, wait)]."""
+
+        return BosMetaDB.connect().execute(
+            'SELECT lockfile, SUM(count), SUM(contended), SUM(wait)'
+            ' FROM lockstats GROUP BY lockfile ORDER BY SUM(wait) DESC').fetchall()
+
+    @classmethod
+    def trace(cls, fname):
+        """
+        export stats of the last build as chrome trace, loadable by
+        chrome://tracing and compatible viewers.
+
+        return: number of phases exported, 0 if there are none
+        """
+
+        db = BosMetaDB.connect()
+        row = db.execute('SELECT MAX(build) FROM stats').fetchone()
+        if not row or not row[0]: return 0
+
+        rows = db.execute('SELECT package, phase, start, wall, utime, stime,'
+                          ' maxrss, ret FROM stats WHERE build = ?'
+                          ' ORDER BY start', (row[0],)).fetchall()
+
+        ## phases overlapping in time are put on separate lanes
+        lanes = []
+        events = []
+        for pn, phase, start, wall, utime, stime, maxrss, ret in rows:
+            for lane, end in enumerate(lanes):
+                if end <= start: break
+            else:
+                lane = len(lanes)
+                lanes.append(0)
+            lanes[lane] = start + wall
+
+            events.append({'name': '%s-%s' % (pn, phase), 'cat': phase,
+                           'ph': 'X', 'pid': 0, 'tid': lane,
+                           'ts': int(start * 1e6), 'dur': int(wall * 1e6),
+                           'args': {'utime': utime, 'stime': stime,
+                                    'maxrss': maxrss, 'ret': ret}})
+
+        with open(fname, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+        return len(events)
+
+    @classmethod
+    def _save(cls, name, phase, start, wall, usage, ret):
+
+        try:
+            with BosMetaDB.transaction() as db:
+                db.execute('INSERT INTO stats (build, package, phase, start,'
+                           ' wall, utime, stime, maxrss, ret)'
+                           ' VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                           (_build_id(), name, phase, start, wall,
+                            usage[0], usage[1], usage[2], ret))
+        except Exception as e:
+            Blog.debug('unable to save stats of %s: %s' % (name, e))
+
+    @classmethod
+    def _save_locks(cls):
+        """save lock stats of this process, at exit."""
+
+        from bomb.lockfile import BosLockFile
+
+        with BosLockFile._stats_lock:
+            stats = BosLockFile.stats.items()
+            BosLockFile.stats = {}
+        if not stats: return
+
+        try:
+            with BosMetaDB.transaction() as db:
+                for lockfile, st in stats:
+                    key = (_build_id(), lockfile)
+                    db.execute('INSERT OR IGNORE INTO lockstats'
+                               ' (build, lockfile, count, contended, wait)'
+                               ' VALUES (?, ?, 0, 0, 0)', key)
+                    db.execute('UPDATE lockstats SET count = count + ?,'
+                               ' contended = contended + ?, wait = wait + ?'
+                               ' WHERE build = ? AND lockfile = ?',
+                               tuple(st) + key)
+        except: pass ## no database, or shutting down
+
+atexit.register(BosStats._save_locks)
+
+
+def _build_id():
+
+    return os.environ.get('_BOS_LOGID_', '0')
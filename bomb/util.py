@@ -13,43 +13,304 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
-import os, sys, time, shutil
-import subprocess, fcntl, select
+import os, sys, time, stat, shutil, errno, fcntl, threading, tempfile
+import subprocess
 
 from bomb.main import Bos
 from bomb.log import BosLog, Blog
+from bomb.stats import BosStats
 
-def bos_run(args, logname = None):
+_RUN_BUFSIZE = 1 << 16
+_PAGE_KB = os.sysconf('SC_PAGE_SIZE') / 1024
+
+## ioctl sharing data blocks of one file with another, linux/fs.h
+_FICLONE = 0x40049409
+
+## scandir of python 3.5, or its backport, if available
+try: from os import scandir as _scandir
+except ImportError:
+    try: from scandir import scandir as _scandir
+    except ImportError: _scandir = None
+
+def bos_run(args, logname = None, env = None):
     """
-    run command in sub-process and collect output to logname if specified
+    run command in sub-process and collect output to logname if specified,
+    with given environment or the current process environment if not.
+
+    file descriptors are inherited, so that make run as the command joins
+    the jobserver passed on in MAKEFLAGS.
 
     return a tuple of (command return code, actual log name)
     """
 
-    if logname:
-        log = BosLog('%s-%s' % (logname, int(time.time())),
-                     quiet = os.environ['_BOS_VERBOSE_'] == 'no',
-                     timestamp = False)
+    if not logname:
+        ## output is not collected, no need to read it at all
+        with open(os.devnull, 'w') as null:
+            proc = subprocess.Popen(args, stdout=null, stderr=subprocess.STDOUT,
+                                    env=env, close_fds=False)
+            return (_wait(proc, _sampler(proc)), None)
+
+    log = BosLog('%s-%s' % (logname, int(time.time())),
+                 quiet = os.environ['_BOS_VERBOSE_'] == 'no',
+                 timestamp = False,
+                 compress = os.environ.get('_BOS_LOGZ_') == 'yes')
 
     proc = subprocess.Popen(args, stdout=subprocess.PIPE,
-                            stderr=subprocess.STDOUT)
+                            stderr=subprocess.STDOUT, env=env, close_fds=False)
+    sampler = _sampler(proc)
+
+    ## read output in large chunks, log complete lines of each chunk in one
+    ## batch, and keep the trailing partial line until its end arrives.
+    fd = proc.stdout.fileno()
+    partial = []
+    while True:
+        buf = os.read(fd, _RUN_BUFSIZE)
+        if not buf: break
+
+        eol = buf.rfind('\n')
+        if eol < 0:
+            partial.append(buf)
+            continue
+
+        partial.append(buf[:eol])
+        log.write(''.join(partial).split('\n'))
+        partial = [buf[eol + 1:]]
+
+    ## output may not end with new line
+    partial = ''.join(partial)
+    if partial: log.write([partial])
+
+    proc.stdout.close()
+    ret = _wait(proc, sampler)
+    log.close()
+
+    return (ret, log.name)
+
+
+def _wait(proc, sampler = None):
+    """
+    wait for sub-process to exit, and account its resource usage to the
+    package phase being run, with the peak RSS of its process tree if
+    sampled.
+
+    return sub-process return code
+    """
+
+    while True:
+        try:
+            pid, status, ru = os.wait4(proc.pid, 0)
+            break
+        except OSError as e:
+            if e.errno != errno.EINTR: raise
+
+    if os.WIFSIGNALED(status): proc.returncode = -os.WTERMSIG(status)
+    else: proc.returncode = os.WEXITSTATUS(status)
+
+    BosStats.account(ru, sampler.stop() if sampler else 0)
+    return proc.returncode
+
+
+def _sampler(proc):
+    """return RSS sampler of process tree, None if no phase is recorded."""
+
+    return _RssSampler(proc.pid) if BosStats.recording() else None
+
+
+class _RssSampler(threading.Thread):
+    """
+    sampler of the RSS of a process and all its descendants, summed, kept
+    at its peak. ru_maxrss of wait4 is the largest single process only,
+    not e.g. all compilers run in parallel by one make.
+    """
+
+    interval = .5
+
+    def __init__(self, pid):
+
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.pid = pid
+        self.peak = 0
+        self.done = threading.Event()
+        self.start()
+
+    def run(self):
+
+        while not self.done.wait(self.interval):
+            try: self.peak = max(self.peak, _tree_rss(self.pid))
+            except (IOError, OSError): pass
+
+    def stop(self):
+        """stop sampling, return peak RSS in KB."""
+
+        self.done.set()
+        self.join()
+        return self.peak
+
+
+def _tree_rss(pid):
+    """return RSS in KB of process and all its descendants, summed."""
+
+    children = {}
+    rss = {}
+    for fn in os.listdir('/proc'):
+        if not fn.isdigit(): continue
+        try:
+            with open('/proc/%s/stat' % fn) as f: st = f.read()
+        except IOError: continue ## exited meanwhile
+
+        ## fields after command name, which may contain anything
+        fields = st[st.rfind(')') + 2:].split()
+        children.setdefault(int(fields[1]), []).append(int(fn))
+        rss[int(fn)] = int(fields[21])
+
+    total = 0
+    todo = [pid]
+    while todo:
+        p = todo.pop()
+        total += rss.get(p, 0)
+        todo.extend(children.get(p, []))
+    return total * _PAGE_KB
 
-    fcntl.fcntl(proc.stdout.fileno(), fcntl.F_SETFL,
-                fcntl.fcntl(proc.stdout.fileno(), fcntl.F_GETFL) |
-                os.O_NONBLOCK)
 
-    chunk = ''
-    while proc.poll() == None:
-        readx = select.select([proc.stdout.fileno()], [], [])[0]
-        if readx:
-            chunk = chunk + proc.stdout.read()
-            if logname:
-                lines = chunk.split('\n')
-                for line in lines:
-                    if line != lines[-1]: log.info(line)
-                chunk = lines[-1]
+def bos_clone(src, dest):
+    """
+    copy file src to dest, sharing its data blocks instead if the filesystem
+    supports reflinks. dest must not exist.
+
+    return True if cloned, False if copied
+    """
+
+    with open(src, 'rb') as fi:
+        fd = os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600)
+        with os.fdopen(fd, 'wb') as fo:
+            try:
+                fcntl.ioctl(fo.fileno(), _FICLONE, fi.fileno())
+                cloned = True
+            except IOError:
+                shutil.copyfileobj(fi, fo, 1 << 20)
+                cloned = False
+
+    shutil.copystat(src, dest)
+    return cloned
+
+
+def bos_install_file(src, dest, keep = False):
+    """
+    install file src as dest without copying its data if possible: src is
+    renamed, or hard linked or cloned if it is to be kept. data is only
+    copied across filesystems, or where neither links nor reflinks work.
+
+    return how src was installed: 'rename', 'link', 'clone' or 'copy'
+    """
+
+    if not keep:
+        try:
+            os.rename(src, dest)
+            return 'rename'
+        except OSError as e:
+            if e.errno != errno.EXDEV: raise
+        shutil.move(src, dest)
+        return 'copy'
+
+    if os.path.islink(src):
+        os.symlink(os.readlink(src), dest)
+        return 'link'
+
+    try:
+        os.link(src, dest)
+        return 'link'
+    except OSError as e:
+        if e.errno not in [errno.EXDEV, errno.EPERM, errno.EMLINK]: raise
+
+    return 'clone' if bos_clone(src, dest) else 'copy'
+
+
+def bos_write_changed(path, content):
+    """
+    write file atomically, only if its content changed, so that make does
+    not see mtime changes for the same content.
+    """
+
+    try:
+        with open(path) as f:
+            if f.read() == content: return
+    except IOError: pass
 
-    return (proc.returncode, log.name if logname else None)
+    Blog.debug('updating %s' % path)
+    fd, tmp = tempfile.mkstemp(dir = os.path.dirname(path))
+    with os.fdopen(fd, 'w') as f: f.write(content)
+    os.chmod(tmp, 0644)
+    os.rename(tmp, path)
+
+
+def bos_scan_tree(root, jobs = 1):
+    """
+    list everything under root in a single traversal, directories of the
+    same depth are listed by up to 'jobs' threads in parallel. symlinks to
+    directories are not followed.
+
+    return a tuple of ({path: lstat result} of all but directories,
+    [directories]), with paths relative to root
+    """
+
+    root = root.rstrip('/') + '/'
+    files = {}
+    dirs = []
+
+    pool = None
+    if jobs > 1:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(jobs)
+
+    try:
+        level = ['']
+        while level:
+            if pool and len(level) > 1:
+                results = pool.map(lambda d: _scan_dir(root, d), level)
+            else:
+                results = [_scan_dir(root, d) for d in level]
+
+            level = []
+            for f, d in results:
+                files.update(f)
+                level.extend(d)
+            dirs.extend(level)
+    finally:
+        if pool: pool.close()
+
+    return (files, dirs)
+
+
+def _scan_dir(root, rel):
+    """return ({path: lstat result}, [sub-directories]) of one directory."""
+
+    prefix = rel + '/' if rel else ''
+    files = {}
+    subdirs = []
+
+    if _scandir:
+        for e in _scandir(root + rel):
+            if e.is_dir(follow_symlinks = False): subdirs.append(prefix + e.name)
+            else: files[prefix + e.name] = e.stat(follow_symlinks = False)
+    else:
+        for fn in os.listdir(root + rel):
+            st = os.lstat(root + prefix + fn)
+            if stat.S_ISDIR(st.st_mode): subdirs.append(prefix + fn)
+            else: files[prefix + fn] = st
+
+    return (files, subdirs)
+
+
+def bos_mem_available():
+    """return memory available for new processes in KB, None if unknown."""
+
+    try:
+        with open('/proc/meminfo') as f:
+            for l in f:
+                if l.startswith('MemAvailable:'): return int(l.split()[1])
+    except IOError: pass
+    return None
 
 
 def bos_rm_empty_path(path, base):
@@ -144,12 +405,14 @@ filemode_table = (
      (TOEXEC,       "x"))
 )
 
-import os, sys, stat
+_filemodes = {}
 def _filemode(mode):
     """
     Convert a file's mode to a string of the form
     -rwxrwxrwx.
     """
+    if mode in _filemodes: return _filemodes[mode]
+
     perm = []
     for table in filemode_table:
         for bit, char in table:
@@ -158,12 +421,14 @@ def _filemode(mode):
                 break
         else:
             perm.append("-")
-    return "".join(perm)
+    _filemodes[mode] = "".join(perm)
+    return _filemodes[mode]
 
-def bos_fileinfo(path):
-    """return file mode and size. """
+def bos_fileinfo(path, st = None):
+    """return file mode and size, of given lstat result if any. """
 
-    if not os.path.exists(path): return ('----------', 0)
+    if st is None:
+        if not os.path.exists(path): return ('----------', 0)
+        st = os.lstat(path)
 
-    st = os.lstat(path)
     return (_filemode(st.st_mode), st.st_size)
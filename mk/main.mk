@@ -1,13 +1,21 @@
 -include deps.mk
 
 E := ${BOS_TOPDIR}/bos/exe/
+
+## package recipes are marked recursive (+), so that package makes share the
+## jobserver of bosm
 bos_statedir := $(CURDIR)/states/
 bos_toolchain_packages := $(shell cat toolchain-packages 2>/dev/null)
 bos_packages := $(shell cat packages 2>/dev/null)
 
 bos_all_packages := $(bos_toolchain_packages) $(bos_packages)
 
-all: $(addsuffix .d,$(addprefix $(bos_statedir),$(bos_all_packages)))
+## packages in build order written by bosm, if any, so that make -j starts
+## packages on the critical path first
+bos_order := $(filter $(bos_all_packages),$(shell cat order 2>/dev/null))
+bos_order += $(filter-out $(bos_order),$(bos_all_packages))
+
+all: $(addsuffix .d,$(addprefix $(bos_statedir),$(bos_order)))
 	@:
 
 clean: $(addsuffix -clean,$(bos_all_packages))
@@ -17,53 +25,58 @@ $(bos_packages): $(bos_toolchain_packages)
 
 $(bos_all_packages):
 	@$(E)boslog -d "main.mk: building $@"
-	@$(E)bosclean $@
-	@$(E)bosprepare $@
-	@$(E)bosconfig $@
-	@$(E)boscompile $@
-	@$(E)bosinstall $@
+	+@$(E)bosclean $@
+	+@$(E)bosprepare $@
+	+@$(E)bosconfig $@
+	+@$(E)boscompile $@
+	+@$(E)bosinstall $@
 
 $(addsuffix -prepare,$(bos_all_packages)):
 	@$(E)boslog -d "main.mk: preparing ${subst -prepare,, $(@F)}."
-	@$(E)bosprepare ${subst -prepare,, $(@F)}
+	+@$(E)bosprepare ${subst -prepare,, $(@F)}
 
 $(addsuffix -config,$(bos_all_packages)):
 	@$(E)boslog -d "main.mk: configuring ${subst -config,, $(@F)}."
-	@$(E)bosconfig ${subst -prepare,, $(@F)}
+	+@$(E)bosconfig ${subst -prepare,, $(@F)}
 
 $(addsuffix -compile,$(bos_all_packages)):
 	@$(E)boslog -d "main.mk: compiling ${subst -compile,, $(@F)}."
-	@$(E)boscompile ${subst -compile,, $(@F)}
+	+@$(E)boscompile ${subst -compile,, $(@F)}
 
 $(addsuffix -install,$(bos_all_packages)):
 	@$(E)boslog -d "main.mk: installing ${subst -install,, $(@F)}."
-	@$(E)bosinstall ${subst -install,, $(@F)}
+	+@$(E)bosinstall ${subst -install,, $(@F)}
 
 $(addsuffix -clean,$(bos_all_packages)):
 	@$(E)boslog -d "main.mk: cleaning $(@F)."
-	@$(E)bosclean ${subst -clean,, $(@F)}
+	+@$(E)bosclean ${subst -clean,, $(@F)}
 
 $(addsuffix -purge,$(bos_all_packages)):
 	@$(E)boslog -d "main.mk: purging $(@F)."
-	@$(E)bospurge ${subst -purge,, $(@F)}
+	+@$(E)bospurge ${subst -purge,, $(@F)}
 
 .PHONY: bootstrap
 bootstrap:
 	@$(MAKE) -f ${BOS_TOPDIR}/bos/mk/bootstrap.mk $@
 
-$(addsuffix .p,$(addprefix $(bos_statedir),$(bos_all_packages))): .rebuild
 $(addsuffix .p,$(addprefix $(bos_statedir),$(bos_all_packages))): %.p: %.v
 	@$(E)boslog -d "main.mk: preparing ${subst .p,, $(@F)} as dependency."
-	@$(E)bosprepare ${subst .p,, $(@F)}
+	+@$(E)bosprepare ${subst .p,, $(@F)}
 
 $(addsuffix .f,$(addprefix $(bos_statedir),$(bos_all_packages))): %.f: %.p
 	@$(E)boslog -d "main.mk: configuring ${subst .f,, $(@F)} as dependency."
-	@$(E)bosconfig ${subst .f,, $(@F)}
+	+@$(E)bosconfig ${subst .f,, $(@F)}
 
 $(addsuffix .b,$(addprefix $(bos_statedir),$(bos_all_packages))): %.b: %.f
 	@$(E)boslog -d "main.mk: compiling ${subst .b,, $(@F)} as dependency."
-	@$(E)boscompile ${subst .b,, $(@F)}
+	+@$(E)boscompile ${subst .b,, $(@F)}
 
 $(addsuffix .d,$(addprefix $(bos_statedir),$(bos_all_packages))): %.d: %.b
 	@$(E)boslog -d "main.mk: installing ${subst .d,, $(@F)} as dependency."
-	@$(E)bosinstall ${subst .d,, $(@F)}
+	+@$(E)bosinstall ${subst .d,, $(@F)}
+
+## .c is touched by install only if installed contents changed, make sees it
+## unchanged afterwards and keeps dependents up to date (early cutoff). it is
+## created as old as .d if missing, as for packages installed before .c.
+$(addsuffix .c,$(addprefix $(bos_statedir),$(bos_all_packages))): %.c: %.d
+	@test -e $@ || touch -r $< $@